@@ -0,0 +1,56 @@
+import argparse
+import os
+import sys
+import time
+
+from lxml import etree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mw_checker import Mwchecker  # noqa: E402
+from simulation import build_arp_reply  # noqa: E402
+
+
+def run_parser(mwc, mode, raw_reply):
+    started = time.perf_counter()
+    if mode == 'parse_arp':
+        entries = mwc.parse_arp(etree.fromstring(raw_reply))
+    elif mode == 'iter_arp_tree':
+        entries = list(mwc.iter_arp(etree.fromstring(raw_reply)))
+    else:
+        entries = list(mwc.iter_arp(raw_reply))
+    return time.perf_counter() - started, entries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare ARP parser throughput on synthetic replies')
+    parser.add_argument('--sizes',
+                        type=int,
+                        nargs='+',
+                        default=[1000, 10000, 100000],
+                        help='ARP entries per synthetic reply')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=3,
+                        help='runs per parser, the best one is reported')
+    arguments = parser.parse_args()
+    mwc = Mwchecker(router='benchmark')
+    modes = ('parse_arp', 'iter_arp_tree', 'iter_arp_bytes')
+    print('{:>8} {:>16} {:>10} {:>14}'.format('entries', 'parser',
+                                             'seconds', 'entries/s'))
+    for size in arguments.sizes:
+        raw_reply = build_arp_reply(size)
+        reference = None
+        for mode in modes:
+            best = None
+            for _ in range(arguments.repeat):
+                elapsed, entries = run_parser(mwc, mode, raw_reply)
+                best = elapsed if best is None else min(best, elapsed)
+            if reference is None:
+                reference = entries
+            elif entries != reference:
+                raise SystemExit('{} output differs from parse_arp'.format(
+                    mode))
+            print('{:>8} {:>16} {:>10.4f} {:>14.0f}'.format(
+                size, mode, best, size / best))
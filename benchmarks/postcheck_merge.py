@@ -0,0 +1,138 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mw_checker import ArpEntry, Mwchecker, PingResult  # noqa: E402
+from simulation import build_arp_entries  # noqa: E402
+
+PRECHECK_TABLE = 'precheck_0'
+POSTCHECK_TABLE = 'postcheck_0'
+# the merge of earlier versions, one update and one insert per ARP entry
+PER_ROW_SCRIPT = (Mwchecker.HOST_SQL,
+                  'UPDATE postcheck_hosts SET host_id = '
+                  '(SELECT host_id FROM hosts '
+                  'WHERE address_id = postcheck_hosts.address_id '
+                  'AND mac=?2 AND ifl=?3 AND irb=?4) '
+                  'WHERE snapshot_id = {snapshot} AND address_id = '
+                  '(SELECT address_id FROM addresses WHERE ip=?1)',
+                  'INSERT INTO postcheck_hosts '
+                  '(snapshot_id, host_id) '
+                  'SELECT {snapshot}, host_id FROM hosts '
+                  'WHERE address_id = '
+                  '(SELECT address_id FROM addresses WHERE ip=?1) '
+                  'AND mac=?2 AND ifl=?3 AND irb=?4 '
+                  'AND NOT EXISTS (SELECT 1 FROM postcheck_hosts '
+                  'WHERE snapshot_id = {snapshot} '
+                  'AND address_id = hosts.address_id) '
+                  'AND NOT EXISTS (SELECT 1 FROM postcheck_hosts '
+                  'WHERE snapshot_id = {snapshot} AND host_id IN '
+                  '(SELECT known.host_id FROM hosts AS known '
+                  'WHERE known.address_id = hosts.address_id))')
+DUMP_SQL = ('SELECT * FROM addresses ORDER BY address_id',
+            'SELECT * FROM hosts ORDER BY host_id',
+            'SELECT rowid, * FROM postcheck_hosts ORDER BY rowid')
+
+
+def build_scenario(size, seed):
+    # the postcheck ARP table lost some hosts, learned new ones, lists
+    # moved hosts twice and comes in another order than the precheck one
+    generator = random.Random(seed)
+    precheck = [ArpEntry(entry['ip'], entry['mac'],
+                         entry['interface'].split()[-1].strip('[]'),
+                         entry['interface'].split()[0]
+                         if entry['interface'].startswith('irb') else 'n_a')
+                for entry in build_arp_entries(size)]
+    probed = [entry.arp_ip for entry in precheck
+              if generator.random() < 0.9]
+    postcheck = [entry for entry in precheck if generator.random() < 0.95]
+    for entry in generator.sample(postcheck, len(postcheck) // 30):
+        postcheck.append(entry._replace(arp_mac='00:00:00:00:00:99'))
+    for index in range(size // 50):
+        postcheck.append(ArpEntry('172.16.{}.{}'.format(index >> 8 & 0xFF,
+                                                        index & 0xFF),
+                                  '00:00:00:00:00:77', 'ge-0/0/1.0', 'n_a'))
+    generator.shuffle(postcheck)
+    return precheck, probed, postcheck
+
+
+def prepare(dbname, precheck, probed):
+    mwc = Mwchecker(router=dbname)
+    mwc.init_precheck_database(PRECHECK_TABLE)
+    mwc.store_precheck_arp(PRECHECK_TABLE, precheck)
+    mwc.init_postcheck_database(POSTCHECK_TABLE)
+    snapshot = mwc.get_snapshot_id(POSTCHECK_TABLE)
+    mwc.execute_many(mwc.POSTCEHCK_PING_SQL.format(snapshot=snapshot),
+                     [PingResult(ip, 'OK', rtt=1.0, loss=0.0)
+                      for ip in probed])
+    return mwc
+
+
+def merge(mwc, mode, postcheck):
+    started = time.perf_counter()
+    if mode == 'per_row':
+        snapshot = mwc.get_snapshot_id(POSTCHECK_TABLE)
+        mwc.store_arp([querry.format(snapshot=snapshot)
+                       for querry in PER_ROW_SCRIPT], postcheck)
+    else:
+        mwc.store_postcheck_arp(POSTCHECK_TABLE, postcheck)
+    return time.perf_counter() - started
+
+
+def dump(mwc):
+    return [[tuple(row) for row in mwc.iterate(querry)]
+            for querry in DUMP_SQL]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=('Compare the set based postcheck ARP merge with the '
+                     'per entry statements of earlier versions'))
+    parser.add_argument('--sizes',
+                        type=int,
+                        nargs='+',
+                        default=[1000, 10000, 50000, 100000],
+                        help='ARP entries of the precheck snapshot')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0)
+    parser.add_argument('--set-based-only',
+                        action='store_true',
+                        help='skip the per entry reference and the '
+                             'comparison of the resulting rows')
+    arguments = parser.parse_args()
+    modes = ('set_based',) if arguments.set_based_only else ('per_row',
+                                                              'set_based')
+    workdir = os.getcwd()
+    print('{:>8} {:>10} {:>10} {:>10} {:>12}  {}'.format(
+        'entries', 'mode', 'first', 'again', 'us/entry', 'rows'))
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        try:
+            for size in arguments.sizes:
+                precheck, probed, postcheck = build_scenario(size,
+                                                             arguments.seed)
+                dumps = {}
+                for mode in modes:
+                    mwc = prepare('{}_{}'.format(mode, size), precheck, probed)
+                    first = merge(mwc, mode, postcheck)
+                    # fetching the ARP table into the same ID again
+                    again = merge(mwc, mode, postcheck)
+                    dumps[mode] = dump(mwc)
+                    mwc.close()
+                    same = ''
+                    if mode == 'set_based' and 'per_row' in dumps:
+                        same = ('identical' if dumps[mode] == dumps['per_row']
+                                else 'DIFFERENT')
+                    print('{:>8} {:>10} {:>10.4f} {:>10.4f} {:>12.2f}  {}'.format(
+                        len(postcheck), mode, first, again,
+                        first / len(postcheck) * 1e6, same))
+                    if same == 'DIFFERENT':
+                        raise SystemExit('set based merge differs from the '
+                                         'per entry statements')
+        finally:
+            os.chdir(workdir)
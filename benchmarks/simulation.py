@@ -0,0 +1,171 @@
+import asyncio
+import os
+import random
+import socket
+import sys
+import time
+
+from lxml import etree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mw_checker import IcmpPinger, Mwchecker  # noqa: E402
+
+ARP_ENTRY = ('<arp-table-entry>\n'
+             '<mac-address>{mac}</mac-address>\n'
+             '<ip-address>{ip}</ip-address>\n'
+             '<interface-name>{interface}</interface-name>\n'
+             '<arp-table-entry-flags><none/></arp-table-entry-flags>\n'
+             '</arp-table-entry>\n')
+
+
+def build_arp_entries(size, irb_share=0.8, irb_count=4000):
+    entries = []
+    for index in range(size):
+        octets = (index >> 16 & 0xFF, index >> 8 & 0xFF, index & 0xFF)
+        if index % 100 < irb_share * 100:
+            vlan = index % irb_count + 1
+            interface = 'irb.{} [ge-0/0/{}.{}]'.format(vlan, index % 48, vlan)
+        else:
+            interface = 'ge-0/0/{}.0'.format(index % 48)
+        entries.append({'mac': '00:00:{:02x}:{:02x}:{:02x}:10'.format(*octets),
+                        'ip': '10.{}.{}.{}'.format(*octets),
+                        'interface': interface})
+    return entries
+
+
+def build_arp_reply(size=None, irb_share=0.8, entries=None):
+    if entries is None:
+        entries = build_arp_entries(size, irb_share)
+    return ('<rpc-reply><arp-table-information>'
+            '{}<arp-entry-count>{}</arp-entry-count>'
+            '</arp-table-information></rpc-reply>'
+            ).format(''.join(ARP_ENTRY.format(**entry) for entry in entries),
+                     len(entries)).encode()
+
+
+def build_ping_reply(host, received, count=2, rtt=1000):
+    # Junos reports round trip times in microseconds
+    summary = ''
+    if received:
+        summary = '<rtt-average>{}</rtt-average>'.format(rtt)
+    return ('<rpc-reply><ping-results>'
+            '<target-host>{host}</target-host>'
+            '<probe-results-summary>'
+            '<probes-sent>{count}</probes-sent>'
+            '<responses-received>{received}</responses-received>'
+            '<packet-loss>{loss}</packet-loss>{summary}'
+            '</probe-results-summary>{status}'
+            '</ping-results></rpc-reply>'
+            ).format(host=host, count=count, received=received,
+                     loss=100 * (count - received) // count, summary=summary,
+                     status='<ping-success/>' if received else '').encode()
+
+
+def build_instance_reply(instances):
+    cores = []
+    for name, interfaces in instances.items():
+        cores.append('<instance-core><instance-name>{}</instance-name>{}'
+                     '</instance-core>'.format(name, ''.join(
+                         '<instance-interface><interface-name>{}'
+                         '</interface-name></instance-interface>'.format(
+                             interface) for interface in interfaces)))
+    return ('<rpc-reply><instance-information>{}</instance-information>'
+            '</rpc-reply>').format(''.join(cores)).encode()
+
+
+class FakeSession:
+    def __init__(self, entries, latency=0.0, loss=0.0, instances=None):
+        self.entries = entries
+        self.latency = latency
+        self.loss = loss
+        self.instances = instances or {}
+        self.random = random.Random(len(entries))
+        self.connected = True
+        self.timeout = None
+        self.requests = []
+
+    def rpc(self, rpc_querry):
+        self.requests.append(etree.tostring(rpc_querry))
+        if rpc_querry.tag == 'ping':
+            time.sleep(self.latency)
+            count = int(rpc_querry.findtext('count'))
+            received = 0 if self.random.random() < self.loss else count
+            return etree.fromstring(build_ping_reply(
+                rpc_querry.findtext('host'), received, count,
+                rtt=round(self.latency * 1000000)))
+        if rpc_querry.tag == 'get-instance-information':
+            return etree.fromstring(build_instance_reply(self.instances))
+        interface = rpc_querry.findtext('interface')
+        entries = self.entries
+        if interface:
+            entries = [entry for entry in entries
+                       if entry['interface'].split()[0] == interface]
+        return etree.fromstring(build_arp_reply(entries=entries))
+
+    def close_session(self):
+        self.connected = False
+
+
+class FakeManager:
+    # stand-in for ncclient.manager, every session serves the same table
+    def __init__(self, size, irb_share=0.8, latency=0.0, loss=0.0,
+                 instances=None):
+        self.entries = build_arp_entries(size, irb_share)
+        self.latency = latency
+        self.loss = loss
+        self.instances = instances
+        self.sessions = []
+
+    def connect(self, **kwargs):
+        session = FakeSession(self.entries, latency=self.latency,
+                              loss=self.loss, instances=self.instances)
+        self.sessions.append(session)
+        return session
+
+
+class SimulatedPinger(IcmpPinger):
+    # keeps the scheduler of the probe engine, replaces the wire with sleeps
+    def __init__(self, latency=0.001, loss=0.0, seed=0, **kwargs):
+        self.latency = latency
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.peer = None
+        super().__init__(**kwargs)
+
+    def open_socket(self):
+        sock, self.peer = socket.socketpair()
+        sock.setblocking(False)
+        return sock
+
+    def close(self):
+        super().close()
+        self.peer.close()
+
+    async def probe(self, host):
+        round_trips = []
+        for _ in range(self.count):
+            if self.random.random() >= self.loss:
+                await asyncio.sleep(self.latency)
+                round_trips.append(self.latency * 1000)
+        if not round_trips:
+            await asyncio.sleep(self.timeout)
+        return Mwchecker.get_ping_result(host, self.count, round_trips)
+
+
+class SimulatedMwchecker(Mwchecker):
+    def __init__(self, router, latency=0.001, loss=0.0, seed=0, **kwargs):
+        super().__init__(router, **kwargs)
+        self.latency = latency
+        self.loss = loss
+        self.seed = seed
+
+    def get_probe_runner(self, hosts_lists, count, timeout,
+                         workers=Mwchecker.WORKERS_NUMBER):
+        pinger = SimulatedPinger(latency=self.latency,
+                                 loss=self.loss,
+                                 seed=self.seed,
+                                 count=count,
+                                 timeout=timeout,
+                                 concurrency=self.ping_concurrency)
+        return self.icmp_pings_runner(pinger, hosts_lists)
@@ -0,0 +1,94 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'mw_checker.py')
+sys.path.insert(0, os.path.dirname(SCRIPT))
+
+from mw_checker import Mwchecker  # noqa: E402
+
+ROUTER = 'startup'
+HEAVY_MODULES = ('ncclient', 'paramiko', 'lxml', 'multiprocessing', 'asyncio')
+# these never reach the router, so they must not pay for its libraries
+OFFLINE_FORBIDDEN = ('ncclient', 'paramiko', 'lxml')
+COMMANDS = ((('report',), True),
+            (('precheck', 'ping'), True),
+            (('postcheck', 'ping'), True),
+            (('monitor', 'report'), True),
+            (('migrate',), True),
+            (('precheck', 'arp', '--help'), False),
+            (('precheck', 'all', '--help'), False),
+            (('postcheck', 'arp', '--help'), False),
+            (('postcheck', 'all', '--help'), False),
+            (('monitor', 'run', '--help'), False))
+
+
+def prepare_database():
+    # empty snapshots, so a task costs its startup and nothing else
+    mwc = Mwchecker(router=ROUTER)
+    mwc.init_precheck_database('precheck_0')
+    mwc.init_postcheck_database('postcheck_0')
+    mwc.init_monitor_database('monitor_0')
+    mwc.close()
+
+
+def run_command(command):
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', SCRIPT,
+                             ROUTER, *command],
+                            capture_output=True, text=True)
+    elapsed = time.perf_counter() - started
+    if result.returncode:
+        raise SystemExit('{} failed:\n{}'.format(' '.join(command),
+                                                 result.stderr))
+    loaded = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        module = line.rsplit('|', 1)[-1].strip().split('.')[0]
+        if module in HEAVY_MODULES:
+            loaded.add(module)
+    return elapsed, loaded
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Time the startup of every mw_checker subcommand')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=5,
+                        help='runs per subcommand, best and median reported')
+    parser.add_argument('--strict',
+                        action='store_true',
+                        help=('exit with an error when a task which does not '
+                              'need the router imports its libraries'))
+    arguments = parser.parse_args()
+    workdir = os.getcwd()
+    violations = []
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        try:
+            prepare_database()
+            print('{:<24} {:>8} {:>8}  {}'.format('command', 'best',
+                                                  'median', 'heavy imports'))
+            for command, offline in COMMANDS:
+                timings = []
+                for _ in range(arguments.repeat):
+                    elapsed, loaded = run_command(command)
+                    timings.append(elapsed)
+                print('{:<24} {:>8.3f} {:>8.3f}  {}'.format(
+                    ' '.join(command), min(timings),
+                    statistics.median(timings),
+                    ', '.join(sorted(loaded)) or '-'))
+                if offline and loaded.intersection(OFFLINE_FORBIDDEN):
+                    violations.append(' '.join(command))
+        finally:
+            os.chdir(workdir)
+    if arguments.strict and violations:
+        raise SystemExit('router libraries imported by: {}'.format(
+            ', '.join(violations)))
@@ -0,0 +1,157 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mw_checker  # noqa: E402
+from simulation import FakeManager, SimulatedMwchecker  # noqa: E402
+
+PRECHECK_TABLE = 'precheck_0'
+POSTCHECK_TABLE = 'postcheck_0'
+
+
+class PhaseTimer:
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.results = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+        elapsed = time.perf_counter() - started
+        self.results.append({'hosts': self.hosts,
+                             'phase': name,
+                             'seconds': round(elapsed, 6),
+                             'hosts_per_second': round(self.hosts / elapsed)
+                             if elapsed else None})
+        print('{:>8} {:<18} {:>10.4f}s'.format(self.hosts, name, elapsed),
+              file=sys.stderr)
+
+
+def run_size(hosts, args):
+    fake_manager = FakeManager(hosts, irb_share=args.irb_share)
+    mw_checker.manager = fake_manager
+    mwc = SimulatedMwchecker(router='bench_{}'.format(hosts),
+                             latency=args.latency,
+                             loss=args.loss,
+                             seed=args.seed,
+                             ping_count=args.count,
+                             ping_timeout=args.timeout,
+                             ping_concurrency=args.concurrency,
+                             ping_adaptive=args.adaptive,
+                             synchronous=args.synchronous)
+    timer = PhaseTimer(hosts)
+    mwc.init_precheck_database(PRECHECK_TABLE)
+    with timer.phase('arp_fetch_parse'):
+        from_box_data = mwc.get_frombox_data(username='bench',
+                                             password='bench')
+        arp_entries = list(mwc.iter_arp(from_box_data['arp']))
+    with timer.phase('arp_db_insert'):
+        mwc.store_precheck_arp(PRECHECK_TABLE, arp_entries)
+    del arp_entries
+    with timer.phase('precheck_ping'):
+        mwc.fetch_precheck_pings(table=PRECHECK_TABLE)
+    mwc.init_postcheck_database(POSTCHECK_TABLE)
+    with timer.phase('postcheck_ping'):
+        mwc.fetch_postcheck_pings(source_table=PRECHECK_TABLE,
+                                  destination_table=POSTCHECK_TABLE)
+    with timer.phase('postcheck_upsert'):
+        mwc.fetch_postcheck_arp(username='bench',
+                                password='bench',
+                                destination_table=POSTCHECK_TABLE)
+    with timer.phase('report'):
+        mwc.get_report(precheck=PRECHECK_TABLE, postcheck=POSTCHECK_TABLE)
+    mwc.close()
+    return timer.results
+
+
+def get_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=('Time every mw_checker phase against a simulated '
+                     'router and simulated hosts'))
+    parser.add_argument('--sizes',
+                        type=int,
+                        nargs='+',
+                        default=[1000, 10000, 100000],
+                        help='ARP entries served by the simulated router')
+    parser.add_argument('--irb-share',
+                        type=float,
+                        default=0.8,
+                        help='share of entries learned on irb interfaces')
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0.001,
+                        help='simulated round trip time in seconds')
+    parser.add_argument('--loss',
+                        type=float,
+                        default=0.01,
+                        help='probability that a simulated probe is lost')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='seed of the simulated loss')
+    parser.add_argument('--count',
+                        type=int,
+                        default=mw_checker.Mwchecker.PING_COUNT)
+    parser.add_argument('--timeout',
+                        type=float,
+                        default=0.05,
+                        help='seconds a lost host keeps its probe slot busy')
+    parser.add_argument('--concurrency',
+                        type=int,
+                        default=mw_checker.Mwchecker.PING_CONCURRENCY)
+    parser.add_argument('--adaptive',
+                        action='store_true')
+    parser.add_argument('--synchronous',
+                        default=mw_checker.DBHandler.SYNCHRONOUS)
+    parser.add_argument('--label',
+                        default=None,
+                        help='name of this run, git describe by default')
+    parser.add_argument('--output',
+                        default=None,
+                        help='JSON results file, stdout by default')
+    arguments = parser.parse_args()
+
+    results = []
+    workdir = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        try:
+            for size in arguments.sizes:
+                results.extend(run_size(size, arguments))
+        finally:
+            os.chdir(workdir)
+    report = {'label': arguments.label or get_version(),
+              'python': platform.python_version(),
+              'sqlite': mw_checker.sqlite3.sqlite_version,
+              'platform': platform.platform(),
+              'parameters': {key: value for key, value in
+                             vars(arguments).items()
+                             if key not in ('label', 'output')},
+              'results': results}
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -1,14 +1,26 @@
 import argparse
 import csv
 import datetime as dt
+import importlib
+import io
+import itertools
+import json
 import logging
 import os
 import re
+import signal
+import socket
 import sqlite3
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import partial
 from getpass import getpass
-from lxml import etree
-from multiprocessing import Pool
-from ncclient import manager
+from math import ceil
 from time import sleep
 
 logging.basicConfig(level=logging.INFO,
@@ -21,23 +33,308 @@ class MwcheckerError(BaseException):
     pass
 
 
+class LazyModule:
+    # report and ping tasks never talk to the router, so ncclient, lxml
+    # and friends are only imported once a code path touches them
+    def __init__(self, name):
+        self.__name = name
+
+    def __getattr__(self, attribute):
+        value = getattr(importlib.import_module(self.__name), attribute)
+        setattr(self, attribute, value)
+        return value
+
+
+asyncio = LazyModule('asyncio')
+cProfile = LazyModule('cProfile')
+futures = LazyModule('concurrent.futures')
+multiprocessing = LazyModule('multiprocessing')
+etree = LazyModule('lxml.etree')
+manager = LazyModule('ncclient.manager')
+rpc_errors = LazyModule('ncclient.operations')
+transport_errors = LazyModule('ncclient.transport.errors')
+
+
+ArpEntry = namedtuple('ArpEntry', 'arp_ip arp_mac arp_ifl arp_irb')
+ArpFilter = namedtuple('ArpFilter', 'irb ifl', defaults=('', ''))
+PingResult = namedtuple('PingResult', 'arp_ip ping ping_stage rtt loss',
+                        defaults=(None, None, None))
+
+
+class HostList:
+    # IPv4 addresses packed into 4 bytes each, anything else kept as text
+    __slots__ = ('addresses', 'others')
+    ADDRESS = struct.Struct('!I')
+
+    def __init__(self, hosts=()):
+        self.addresses = array('I')
+        self.others = []
+        for host in hosts:
+            self.append(host)
+
+    def append(self, host):
+        try:
+            packed = socket.inet_aton(host)
+        except (OSError, TypeError):
+            self.others.append(host)
+            return
+        if socket.inet_ntoa(packed) != host:
+            self.others.append(host)
+            return
+        self.addresses.append(self.ADDRESS.unpack(packed)[0])
+
+    def __len__(self):
+        return len(self.addresses) + len(self.others)
+
+    def __iter__(self):
+        pack = self.ADDRESS.pack
+        for address in self.addresses:
+            yield socket.inet_ntoa(pack(address))
+        yield from self.others
+
+
+class Span:
+    # seconds of a running phase which belong to another one
+    __slots__ = ('excluded',)
+
+    def __init__(self):
+        self.excluded = 0.0
+
+
+class Metrics:
+    PREFIX = 'mw_checker'
+    HISTOGRAM_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                         0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, enabled=False, profile_dir=None, labels=None):
+        self.enabled = enabled or profile_dir is not None
+        self.profile_dir = profile_dir
+        self.labels = labels or {}
+        self.phases = {}
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.profiling = False
+
+    def __getstate__(self):
+        # pool workers get a disabled copy, their calls stay no-ops
+        return {'enabled': False, 'profile_dir': None, 'labels': {}}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @contextmanager
+    def phase(self, name):
+        # work done inside the phase but timed on its own, e.g. by a
+        # generator consumed in it, is added to the span and left out
+        span = Span()
+        if not self.enabled:
+            yield span
+            return
+        profiler = self.start_profiler()
+        started = time.perf_counter()
+        try:
+            yield span
+        finally:
+            elapsed = time.perf_counter() - started - span.excluded
+            if profiler is not None:
+                self.stop_profiler(profiler, name)
+            self.record(name, elapsed)
+
+    def record(self, name, elapsed):
+        if not self.enabled:
+            return
+        with self.lock:
+            runs, total, longest = self.phases.get(name, (0, 0.0, 0.0))
+            self.phases[name] = (runs + 1, total + elapsed,
+                                 max(longest, elapsed))
+
+    def start_profiler(self):
+        # one profiler at a time, nested or concurrent phases are timed only
+        if self.profile_dir is None:
+            return None
+        with self.lock:
+            if self.profiling:
+                return None
+            self.profiling = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def stop_profiler(self, profiler, name):
+        profiler.disable()
+        os.makedirs(self.profile_dir, exist_ok=True)
+        runs = self.phases.get(name, (0,))[0]
+        profiler.dump_stats(os.path.join(self.profile_dir,
+                                         '{}_{}.prof'.format(name, runs)))
+        with self.lock:
+            self.profiling = False
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {
+                    'buckets': [0] * len(self.HISTOGRAM_BUCKETS),
+                    'sum': 0.0,
+                    'count': 0}
+            for index, bound in enumerate(self.HISTOGRAM_BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def summary(self):
+        with self.lock:
+            return {
+                'labels': dict(self.labels),
+                'phases': {name: {'runs': runs,
+                                  'seconds': round(total, 6),
+                                  'max_seconds': round(longest, 6)}
+                           for name, (runs, total, longest)
+                           in self.phases.items()},
+                'counters': dict(self.counters),
+                'histograms': {
+                    name: {'buckets': dict(zip(
+                               self.HISTOGRAM_BUCKETS,
+                               itertools.accumulate(histogram['buckets']))),
+                           'sum': round(histogram['sum'], 6),
+                           'count': histogram['count']}
+                    for name, histogram in self.histograms.items()}}
+
+    def export_json(self, path):
+        self.write_atomic(path, json.dumps(self.summary(), indent=2) + '\n')
+
+    def export_prometheus(self, path):
+        summary = self.summary()
+        lines = []
+        phase_metrics = (('phase_seconds_total', 'seconds'),
+                         ('phase_max_seconds', 'max_seconds'),
+                         ('phase_runs_total', 'runs'))
+        for metric, field in phase_metrics:
+            metric_type = 'gauge' if 'max' in metric else 'counter'
+            lines.append('# TYPE {}_{} {}'.format(self.PREFIX, metric,
+                                                   metric_type))
+            for name, phase in summary['phases'].items():
+                lines.append('{}_{}{} {}'.format(
+                    self.PREFIX, metric, self.format_labels(phase=name),
+                    phase[field]))
+        for name, value in summary['counters'].items():
+            lines.append('# TYPE {}_{}_total counter'.format(self.PREFIX,
+                                                              name))
+            lines.append('{}_{}_total{} {}'.format(
+                self.PREFIX, name, self.format_labels(), value))
+        for name, histogram in summary['histograms'].items():
+            lines.append('# TYPE {}_{} histogram'.format(self.PREFIX, name))
+            for bound, total in histogram['buckets'].items():
+                lines.append('{}_{}_bucket{} {}'.format(
+                    self.PREFIX, name, self.format_labels(le=bound), total))
+            lines.append('{}_{}_bucket{} {}'.format(
+                self.PREFIX, name, self.format_labels(le='+Inf'),
+                histogram['count']))
+            lines.append('{}_{}_sum{} {}'.format(
+                self.PREFIX, name, self.format_labels(), histogram['sum']))
+            lines.append('{}_{}_count{} {}'.format(
+                self.PREFIX, name, self.format_labels(), histogram['count']))
+        self.write_atomic(path, '\n'.join(lines) + '\n')
+
+    def format_labels(self, **extra):
+        labels = dict(self.labels, **extra)
+        if not labels:
+            return ''
+        return '{{{}}}'.format(','.join(
+            '{}="{}"'.format(key, str(value).replace('\\', '\\\\')
+                             .replace('"', '\\"'))
+            for key, value in labels.items()))
+
+    @staticmethod
+    def write_atomic(path, content):
+        # the node exporter must never read a half written textfile
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary, 'w') as output:
+            output.write(content)
+        os.replace(temporary, path)
+
+
 class DBHandler:
-    def __init__(self, dbname):
+    JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+    SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+    JOURNAL_MODE = 'WAL'
+    SYNCHRONOUS = 'NORMAL'
+    CACHE_SIZE = -65536
+    MMAP_SIZE = 268435456
+
+    def __init__(self, dbname, journal_mode=JOURNAL_MODE,
+                 synchronous=SYNCHRONOUS, cache_size=CACHE_SIZE,
+                 mmap_size=MMAP_SIZE):
+        if journal_mode.upper() not in self.JOURNAL_MODES:
+            raise MwcheckerError('unknown journal mode {}'.format(journal_mode))
+        if synchronous.upper() not in self.SYNCHRONOUS_LEVELS:
+            raise MwcheckerError('unknown synchronous level {}'.format(
+                synchronous))
         self.dbname = dbname
+        self.journal_mode = journal_mode.upper()
+        self.synchronous = synchronous.upper()
+        self.cache_size = int(cache_size)
+        self.mmap_size = int(mmap_size)
+        self.connection = None
+
+    def __getstate__(self):
+        # connections can't cross process boundaries of the ping pool
+        state = self.__dict__.copy()
+        state['connection'] = None
+        return state
+
+    def get_connection(self):
+        if self.connection is None:
+            con = sqlite3.connect(self.dbname, isolation_level=None,
+                                  check_same_thread=False)
+            con.row_factory = sqlite3.Row
+            con.execute(f'PRAGMA journal_mode={self.journal_mode}')
+            con.execute(f'PRAGMA synchronous={self.synchronous}')
+            con.execute(f'PRAGMA cache_size={self.cache_size}')
+            con.execute(f'PRAGMA mmap_size={self.mmap_size}')
+            self.connection = con
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
 
-    def create_table(self, table_name, fields):
+    @contextmanager
+    def transaction(self):
+        con = self.get_connection()
+        con.execute('BEGIN')
         try:
-            with sqlite3.connect(self.dbname) as con:
+            yield con
+        except BaseException:
+            if con.in_transaction:
+                con.execute('ROLLBACK')
+            raise
+        con.execute('COMMIT')
+
+    def create_table(self, table_name, fields, options=''):
+        try:
+            with self.transaction() as con:
                 task = (f'CREATE TABLE IF NOT EXISTS '
-                        f'{table_name} ({fields}) ')
+                        f'{table_name} ({fields}) {options}')
                 con.execute(task)
         except sqlite3.Error as error:
             logger.error(error, exc_info=True)
 
     def execute(self, sql_request, parameters=None):
         try:
-            with sqlite3.connect(self.dbname) as con:
-                con.row_factory = sqlite3.Row
+            with self.transaction() as con:
                 cursor = con.cursor()
                 if parameters is not None:
                     cursor.execute(sql_request, parameters)
@@ -47,12 +344,46 @@ class DBHandler:
         except sqlite3.Error as error:
             logger.error(error, exc_info=True)
 
+    def add_columns(self, table_name, columns):
+        try:
+            with self.transaction() as con:
+                existing = {row['name'] for row in
+                            con.execute(f'PRAGMA table_info({table_name})')}
+                added = [name for name in columns if name not in existing]
+                for name in added:
+                    con.execute(f'ALTER TABLE {table_name} '
+                                f'ADD COLUMN {name} {columns[name]}')
+                return added
+        except sqlite3.Error as error:
+            logger.error(error, exc_info=True)
+
+    def create_indexes(self, table_name, indexes):
+        try:
+            with self.transaction() as con:
+                for name, columns in indexes.items():
+                    con.execute(f'CREATE INDEX IF NOT EXISTS '
+                                f'{table_name}_{name}_idx '
+                                f'ON {table_name} ({columns})')
+        except sqlite3.Error as error:
+            logger.error(error, exc_info=True)
+
+    def get_object_type(self, name):
+        rows = self.execute('SELECT type FROM sqlite_master WHERE name=?',
+                            (name,))
+        return rows[0]['type'] if rows else None
+
+    def iterate(self, sql_request, parameters=()):
+        try:
+            cursor = self.get_connection().execute(sql_request, parameters)
+            yield from cursor
+        except sqlite3.Error as error:
+            logger.error(error, exc_info=True)
+            raise MwcheckerError(error)
+
     def execute_many(self, sql_request, parameters_deck):
         try:
-            with sqlite3.connect(self.dbname) as con:
-                cursor = con.cursor()
-                for parameters in parameters_deck:
-                    cursor.execute(sql_request, parameters)
+            with self.transaction() as con:
+                con.executemany(sql_request, parameters_deck)
         except sqlite3.IntegrityError as error:
             logger.error(error, exc_info=True)
             raise MwcheckerError(error)
@@ -61,7 +392,7 @@ class DBHandler:
 
     def execute_many_scripts(self, querry_list, parameters_deck):
         try:
-            with sqlite3.connect(self.dbname) as con:
+            with self.transaction() as con:
                 cursor = con.cursor()
                 for parameters in parameters_deck:
                     for querry in querry_list:
@@ -72,8 +403,7 @@ class DBHandler:
     def get_many(self, sql_list):
         list_of_responses = []
         try:
-            with sqlite3.connect(self.dbname) as con:
-                con.row_factory = sqlite3.Row
+            with self.transaction() as con:
                 cursor = con.cursor()
                 for querry in sql_list:
                     cursor.execute(querry)
@@ -84,54 +414,692 @@ class DBHandler:
             logger.error(error, exc_info=True)
 
 
+class IcmpPinger:
+    ICMP_ECHO_REQUEST = 8
+    ICMP_ECHO_REPLY = 0
+    ICMP_HEADER = struct.Struct('!BBHHH')
+    ICMP_PAYLOAD = b'mw_checker_probe'
+    RECEIVE_BUFFER = 2048
+    SOCKET_BUFFER = 4 * 1024 * 1024
+    SEND_RETRY_DELAY = 0.001
+    INSTANCES = itertools.count()
+    # SO_TIMESTAMPNS of Linux, the socket module doesn't export it
+    SO_TIMESTAMPNS = 35
+    TIMESTAMP = struct.Struct('@ll')
+
+    def __init__(self, count=2, timeout=1, concurrency=1024, rate=0,
+                 metrics=None):
+        self.count = max(1, count)
+        self.timeout = timeout
+        self.concurrency = max(1, concurrency)
+        self.rate = max(0, rate)
+        self.next_send = 0
+        # raw sockets see the replies of every pinger of the process
+        self.identifier = (os.getpid() + next(self.INSTANCES)) & 0xFFFF
+        self.sequence = itertools.count()
+        self.waiters = {}
+        self.raw = False
+        self.timestamps = False
+        self.metrics = metrics or Metrics()
+        self.sock = self.open_socket()
+
+    def open_socket(self):
+        # Unprivileged ping sockets need net.ipv4.ping_group_range,
+        # raw sockets need CAP_NET_RAW, try them in that order
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                 socket.IPPROTO_ICMP)
+        except OSError:
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_RAW,
+                                     socket.IPPROTO_ICMP)
+            except OSError as error:
+                raise MwcheckerError(error)
+            self.raw = True
+        try:
+            # thousands of replies in flight must not overflow the queue
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                            self.SOCKET_BUFFER)
+        except OSError:
+            pass
+        if sys.platform.startswith('linux'):
+            try:
+                # kernel receive times keep a busy event loop out of the rtt
+                sock.setsockopt(socket.SOL_SOCKET, self.SO_TIMESTAMPNS, 1)
+                self.timestamps = True
+            except OSError:
+                pass
+        sock.setblocking(False)
+        return sock
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def build_packet(self, sequence):
+        header = self.ICMP_HEADER.pack(self.ICMP_ECHO_REQUEST, 0, 0,
+                                       self.identifier, sequence)
+        checksum = self.checksum(header + self.ICMP_PAYLOAD)
+        header = self.ICMP_HEADER.pack(self.ICMP_ECHO_REQUEST, 0, checksum,
+                                       self.identifier, sequence)
+        return header + self.ICMP_PAYLOAD
+
+    def receive(self):
+        while True:
+            try:
+                packet, ancillary, _, address = self.sock.recvmsg(
+                    self.RECEIVE_BUFFER, socket.CMSG_SPACE(
+                        self.TIMESTAMP.size) if self.timestamps else 0)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue
+            received = time.time()
+            for level, kind, data in ancillary:
+                if (level == socket.SOL_SOCKET and
+                        kind == self.SO_TIMESTAMPNS and
+                        len(data) >= self.TIMESTAMP.size):
+                    seconds, nanoseconds = self.TIMESTAMP.unpack_from(data)
+                    received = seconds + nanoseconds / 1e9
+            if self.raw:
+                packet = packet[(packet[0] & 0x0F) * 4:]
+            if len(packet) < self.ICMP_HEADER.size:
+                continue
+            icmp_type, _, _, identifier, sequence = (
+                self.ICMP_HEADER.unpack_from(packet))
+            if icmp_type != self.ICMP_ECHO_REPLY:
+                continue
+            # the kernel rewrites the identifier of datagram ping sockets
+            if self.raw and identifier != self.identifier:
+                continue
+            waiter = self.waiters.get((address[0], sequence))
+            if waiter is not None and not waiter.done():
+                waiter.set_result(received)
+
+    async def send(self, host, sequence, deadline):
+        # returns the time the request left, None if it couldn't be sent
+        loop = asyncio.get_running_loop()
+        packet = self.build_packet(sequence)
+        while True:
+            try:
+                sent = time.time()
+                self.sock.sendto(packet, (host, 0))
+                return sent
+            except (BlockingIOError, InterruptedError):
+                if loop.time() >= deadline:
+                    return None
+                await asyncio.sleep(self.SEND_RETRY_DELAY)
+            except OSError as error:
+                logger.warning('%s: %s', host, error)
+                return None
+
+    async def pace(self):
+        # hands out evenly spaced send slots, so no more than rate echo
+        # requests per second leave the box whatever the concurrency is
+        if not self.rate:
+            return 0
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self.next_send)
+        self.next_send = slot + 1 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        return slot - now
+
+    async def probe(self, host):
+        # every echo request is sent, so the loss of a host is known too,
+        # a late reply still counts while later requests are awaited
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        interval = self.timeout / self.count
+        probes = []
+        keys = []
+        try:
+            for attempt in range(self.count):
+                # waiting for a send slot doesn't eat into the timeout
+                deadline += await self.pace()
+                sequence = next(self.sequence) & 0xFFFF
+                key = (host, sequence)
+                keys.append(key)
+                waiter = loop.create_future()
+                self.waiters[key] = waiter
+                sent = await self.send(host, sequence, deadline)
+                if sent is None:
+                    break
+                probes.append((sent, waiter))
+                remaining = deadline - loop.time()
+                if attempt < self.count - 1:
+                    remaining = min(interval, remaining)
+                await asyncio.wait((waiter,), timeout=max(remaining, 0))
+            round_trips = []
+            for sent, waiter in probes:
+                if waiter.done():
+                    self.metrics.observe('probe_seconds',
+                                         waiter.result() - sent)
+                    round_trips.append((waiter.result() - sent) * 1000)
+            return Mwchecker.get_ping_result(host, self.count, round_trips)
+        finally:
+            for key in keys:
+                self.waiters.pop(key, None)
+
+    def ping_many(self, hosts):
+        loop = asyncio.new_event_loop()
+        loop.add_reader(self.sock.fileno(), self.receive)
+        hosts = iter(hosts)
+        pending = set()
+        try:
+            while True:
+                for host in hosts:
+                    pending.add(loop.create_task(self.probe(host)))
+                    if len(pending) >= self.concurrency:
+                        break
+                if not pending:
+                    break
+                done, pending = loop.run_until_complete(
+                    asyncio.wait(pending,
+                                 return_when=asyncio.FIRST_COMPLETED))
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.wait(pending))
+            loop.remove_reader(self.sock.fileno())
+            loop.close()
+
+    @staticmethod
+    def checksum(data):
+        if len(data) % 2:
+            data += b'\x00'
+        total = sum(struct.unpack('!{}H'.format(len(data) // 2), data))
+        total = (total >> 16) + (total & 0xFFFF)
+        total += total >> 16
+        return ~total & 0xFFFF
+
+
+class RouterPinger:
+    PING_RPC = 'ping'
+    INSTANCE_RPC = 'get-instance-information'
+    DEFAULT_INSTANCES = ('master', 'default')
+    INSTANCE_XPATH = '//*[local-name()="instance-core"]'
+    INTERFACE_XPATH = './/*[local-name()="interface-name"]'
+    RECEIVED_XPATH = '//*[local-name()="responses-received"]'
+    SENT_XPATH = '//*[local-name()="probes-sent"]'
+    # Junos reports round trip times in microseconds
+    RTT_XPATH = '//*[local-name()="rtt-average"]'
+    SUCCESS_XPATH = '//*[local-name()="ping-success"]'
+    # rpc-errors which report the host itself as unreachable, any other
+    # error says nothing about the host and leaves it without a result
+    UNREACHABLE_ERRORS = ('no route to host', 'host is down',
+                          'network is unreachable', 'host unreachable',
+                          'unknown host')
+
+    def __init__(self, connect, interfaces, count=2, timeout=1, sessions=4,
+                 metrics=None):
+        self.connect = connect
+        self.interfaces = interfaces
+        self.count = max(1, count)
+        self.timeout = timeout
+        self.concurrency = max(1, sessions)
+        self.metrics = metrics or Metrics()
+        self.instances = {}
+        self.sessions = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_session(self):
+        # every worker thread drives its own NETCONF session
+        session = getattr(self.local, 'session', None)
+        if session is None or not session.connected:
+            session = self.connect()
+            self.local.session = session
+            with self.lock:
+                self.sessions.append(session)
+        return session
+
+    def drop_session(self):
+        session = getattr(self.local, 'session', None)
+        self.local.session = None
+        if session is not None:
+            self.close_session(session)
+
+    def close(self):
+        with self.lock:
+            sessions, self.sessions = self.sessions, []
+        for session in sessions:
+            self.close_session(session)
+
+    @staticmethod
+    def close_session(session):
+        try:
+            session.close_session()
+        except Exception as error:
+            logger.warning(error)
+
+    def load_instances(self):
+        reply = self.get_session().rpc(self.build_instance_rpc())
+        for instance in reply.xpath(self.INSTANCE_XPATH):
+            name = Mwchecker.get_xpath(instance, 'instance-name',
+                                       ignore_namespaces=True)
+            if name in self.DEFAULT_INSTANCES:
+                continue
+            for interface in instance.xpath(self.INTERFACE_XPATH):
+                if interface.text:
+                    self.instances[interface.text.strip()] = name
+
+    def build_instance_rpc(self):
+        rpc_querry = etree.Element(self.INSTANCE_RPC)
+        etree.SubElement(rpc_querry, 'detail')
+        return rpc_querry
+
+    def build_rpc(self, host):
+        rpc_querry = etree.Element(self.PING_RPC)
+        etree.SubElement(rpc_querry, 'host').text = host
+        etree.SubElement(rpc_querry, 'count').text = str(self.count)
+        etree.SubElement(rpc_querry, 'wait').text = str(
+            max(1, ceil(self.timeout)))
+        etree.SubElement(rpc_querry, 'rapid')
+        # the ARP interface leads into the right routing instance and
+        # gives the probes the source address the host expects
+        interface = self.interfaces.get(host)
+        if interface:
+            etree.SubElement(rpc_querry, 'interface').text = interface
+            instance = self.instances.get(interface)
+            if instance:
+                etree.SubElement(rpc_querry,
+                                 'routing-instance').text = instance
+        return rpc_querry
+
+    def probe(self, host):
+        # None marks a host the router couldn't probe, it gets no result
+        # so a --resume run probes it again
+        rpc_querry = self.build_rpc(host)
+        started = time.perf_counter()
+        for attempt in range(2):
+            try:
+                reply = self.get_session().rpc(rpc_querry)
+            except rpc_errors.RPCError as error:
+                if self.is_unreachable(error):
+                    logger.info('%s: %s', host, error)
+                    return PingResult(host, 'FAILED', loss=100.0)
+                logger.error('%s: ping rpc failed: %s', host, error)
+                self.metrics.count('router_ping_errors')
+                return None
+            except (transport_errors.TransportError,
+                    rpc_errors.TimeoutExpiredError, OSError) as error:
+                logger.warning('%s: ping rpc attempt %s failed: %s',
+                               host, attempt + 1, error)
+                self.metrics.count('router_ping_retries')
+                self.drop_session()
+                continue
+            if self.is_success(reply):
+                self.metrics.observe('probe_seconds',
+                                     time.perf_counter() - started)
+                return self.get_result(host, reply)
+            return PingResult(host, 'FAILED', loss=100.0)
+        logger.error('%s: ping rpc failed after %s attempts', host,
+                     attempt + 1)
+        self.metrics.count('router_ping_errors')
+        return None
+
+    def is_unreachable(self, error):
+        message = str(error).lower()
+        return any(reason in message for reason in self.UNREACHABLE_ERRORS)
+
+    def is_success(self, reply):
+        received = reply.xpath(self.RECEIVED_XPATH)
+        if received and received[0].text:
+            return int(received[0].text) > 0
+        return bool(reply.xpath(self.SUCCESS_XPATH))
+
+    def get_result(self, host, reply):
+        rtt = self.get_number(reply, self.RTT_XPATH)
+        sent = self.get_number(reply, self.SENT_XPATH) or self.count
+        received = self.get_number(reply, self.RECEIVED_XPATH)
+        loss = None
+        if received is not None:
+            loss = round(100 * max(0, sent - received) / sent, 1)
+        return PingResult(host, 'OK',
+                          rtt=None if rtt is None else round(rtt / 1000, 3),
+                          loss=loss)
+
+    @staticmethod
+    def get_number(reply, path):
+        found = reply.xpath(path)
+        if not found or not found[0].text:
+            return None
+        try:
+            return float(found[0].text)
+        except ValueError:
+            return None
+
+    def ping_many(self, hosts):
+        hosts = iter(hosts)
+        pending = set()
+        skipped = 0
+        with futures.ThreadPoolExecutor(self.concurrency) as executor:
+            executor.submit(self.load_instances).result()
+            try:
+                while True:
+                    for host in hosts:
+                        pending.add(executor.submit(self.probe, host))
+                        if len(pending) >= self.concurrency * 2:
+                            break
+                    if not pending:
+                        break
+                    done, pending = futures.wait(
+                        pending, return_when=futures.FIRST_COMPLETED)
+                    for future in done:
+                        ping = future.result()
+                        if ping is None:
+                            skipped += 1
+                        else:
+                            yield ping
+            finally:
+                for future in pending:
+                    future.cancel()
+        if skipped:
+            print('{}: {} hosts could not be probed by the router, see the '
+                  'log and run the task with --resume to retry them'.format(
+                      Mwchecker.ttime(), skipped))
+
+
+class PingWriter:
+    def __init__(self, db_handler, dest_sql, total, label='',
+                 batch_size=1000, batch_interval=2, metrics=None,
+                 cache_sql=None):
+        self.db_handler = db_handler
+        self.metrics = metrics or Metrics()
+        self.dest_sql = dest_sql
+        self.cache_sql = cache_sql
+        self.cache_batch = []
+        self.total = total
+        self.label = label
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.batch = []
+        self.written = 0
+        self.reachable = 0
+        self.flushed_at = time.monotonic()
+
+    @property
+    def unreachable(self):
+        return self.written - self.reachable
+
+    def add(self, ping, cache=True):
+        self.batch.append(ping)
+        if cache and self.cache_sql:
+            self.cache_batch.append(ping)
+        if ping.ping == 'OK':
+            self.reachable += 1
+        if (len(self.batch) >= self.batch_size or
+                time.monotonic() - self.flushed_at >= self.batch_interval):
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        started = time.perf_counter()
+        self.db_handler.execute_many(self.dest_sql, self.batch)
+        if self.cache_batch:
+            self.db_handler.execute_many(self.cache_sql, self.cache_batch)
+            self.cache_batch = []
+        self.metrics.observe('db_batch_seconds',
+                             time.perf_counter() - started)
+        self.metrics.count('rows_written', len(self.batch))
+        self.written += len(self.batch)
+        self.batch = []
+        self.flushed_at = time.monotonic()
+        label = '{} '.format(self.label) if self.label else ''
+        print('{}: {}{}/{} hosts probed, {} OK, {} FAILED'.format(
+            Mwchecker.ttime(), label, self.written, self.total,
+            self.reachable, self.unreachable))
+
+    def close(self):
+        self.flush()
+
+
 class Mwchecker(DBHandler):
     WORKERS_NUMBER = 8
-    GET_ARP_RPC = etree.fromstring('<get-arp-table-information>'
-                                   '<no-resolve/>'
-                                   '</get-arp-table-information>')
+    PING_BACKENDS = ('icmp', 'subprocess', 'router')
+    PING_BACKEND = 'icmp'
+    PING_COUNT = 2
+    PING_TIMEOUT = 1
+    PING_CONCURRENCY = 1024
+    PING_RATE = 0
+    ROUTER_SESSIONS = 4
+    SWEEP_TIMEOUT = 0.3
+    CONFIRM_ROUNDS = 2
+    # results are reused only with a positive --cache-ttl, in seconds
+    CACHE_TTL = 0
+    CACHE_RETENTION = 86400
+    PING_COLUMNS = {'ping_stage': 'text'}
+    # rtt in milliseconds and loss in percent, added to older databases
+    MEASURE_COLUMNS = {'rtt': 'real', 'loss': 'real'}
+    RTT_THRESHOLD = 10
+    WRITE_BATCH_SIZE = 1000
+    WRITE_BATCH_INTERVAL = 2
+    ARP_BATCH_SIZE = 10000
+    MONITOR_INTERVAL = 60
+    MONITOR_RATE = 2000
+    GET_ARP_RPC = 'get-arp-table-information'
+    CONNECT_ATTEMPTS = 3
+    RPC_ATTEMPTS = 2
+    RETRY_DELAY = 2
+    RPC_TIMEOUT = 300
     ARP_XPATH = '//arp-table-entry'
+    ARP_ENTRY_TAG = '{*}arp-table-entry'
     ARP_IRB_IFL_PATTERN = re.compile(r'(?P<irb>irb\.\d+)\s+\[(?P<ifl>.+)\]')
-    OUTPUT_TASKS = {
-        'arp': GET_ARP_RPC,
-    }
-    CONDITION_EXPRESSION = '{field}{operator}{pattern}'
-    PING_COMMAND = 'ping -c 2 {} -w 1'
+    CONDITION_EXPRESSION = '{field} {operator} ?'
+    # _ stands for any single character, GLOB wildcards are taken literally
+    GLOB_TRANSLATION = str.maketrans({'[': '[[]', '?': '[?]', '_': '?'})
+    PING_COMMAND = 'ping -c {count} {host} -w {timeout}'
     PING_PATTERN_STR = (r'\d+\s+bytes\s+from\s+'
                         r'(?P<host1>{})\:\s+'
-                        r'icmp_seq=\d+\s+ttl=\d+\s+'
-                        r'time=\d+.?\d+\s+ms')
+                        r'icmp_seq=(?P<sequence>\d+)\s+ttl=\d+\s+'
+                        r'time=(?P<time>\d+[.,]?\d*)\s+ms')
     PRECHECK_DB_NAME = 'precheck_mwc'
     POSTCHECK_DB_NAME = 'postcheck_mwc'
-    PRECHECK_FIELDS = ('arp_ip text , '
-                       'arp_mac text, '
-                       'arp_irb text, '
-                       'arp_ifl text, '
-                       'ping text,'
-                       'PRIMARY KEY (arp_ip, arp_mac, arp_irb)')
-    POSTCHECK_FIELDS = ('ip text PRIMARY KEY, '
-                        'arp_ip text, '
-                        'arp_mac text, '
-                        'arp_irb text, '
-                        'arp_ifl text, '
-                        'ping text ')
-    PRECHECK_ARP_SQL = ('INSERT INTO {} '
-                        '(arp_ip, arp_mac, arp_ifl, arp_irb) '
-                        'VALUES '
-                        '(:arp_ip, :arp_mac, :arp_ifl, :arp_irb)')
-    PRECHECK_PING_SQL = ('UPDATE {} SET ping=:ping '
-                         'WHERE arp_ip=:arp_ip AND ping is NULL')
+    ADDRESSES_FIELDS = ('address_id integer PRIMARY KEY, '
+                        'ip text NOT NULL UNIQUE')
+    HOSTS_FIELDS = ('host_id integer PRIMARY KEY, '
+                    'address_id integer NOT NULL, '
+                    'mac text, '
+                    'ifl text, '
+                    'irb text, '
+                    'UNIQUE (address_id, mac, irb, ifl)')
+    SNAPSHOTS_FIELDS = ('snapshot_id integer PRIMARY KEY, '
+                        'name text NOT NULL UNIQUE, '
+                        'stage text NOT NULL, '
+                        'created text')
+    PRECHECK_HOSTS_FIELDS = ('snapshot_id integer, '
+                             'host_id integer, '
+                             'ping text, '
+                             'ping_stage text, '
+                             'rtt real, '
+                             'loss real, '
+                             'PRIMARY KEY (snapshot_id, host_id)')
+    POSTCHECK_HOSTS_FIELDS = ('snapshot_id integer, '
+                              'address_id integer, '
+                              'host_id integer, '
+                              'ping text, '
+                              'ping_stage text, '
+                              'rtt real, '
+                              'loss real, '
+                              'UNIQUE (snapshot_id, address_id)')
+    POSTCHECK_HOSTS_INDEXES = {'host': 'snapshot_id, host_id'}
+    # the last result of every address, probed is in unix seconds
+    PROBE_CACHE_FIELDS = ('address_id integer PRIMARY KEY, '
+                          'backend text, '
+                          'ping text, '
+                          'ping_stage text, '
+                          'rtt real, '
+                          'loss real, '
+                          'probed integer')
+    CACHE_STORE_SQL = ('INSERT OR REPLACE INTO probe_cache (address_id, '
+                       'backend, ping, ping_stage, rtt, loss, probed) '
+                       'SELECT address_id, \'{backend}\', ?2, ?3, ?4, ?5, '
+                       'CAST(strftime(\'%s\', \'now\') AS integer) '
+                       'FROM addresses WHERE ip=?1')
+    CACHE_FRESH_SQL = ('SELECT addresses.ip, probe_cache.ping, ping_stage, '
+                       'rtt, loss FROM probe_cache '
+                       'INNER JOIN addresses ON '
+                       'addresses.address_id = probe_cache.address_id '
+                       'WHERE backend = ? AND probed >= '
+                       'CAST(strftime(\'%s\', \'now\') AS integer) - ?')
+    CACHE_EVICT_SQL = ('DELETE FROM probe_cache WHERE probed < '
+                       'CAST(strftime(\'%s\', \'now\') AS integer) - ?')
+    # created with the first interface filter, the planner prefers them
+    # to a scan of the snapshot only once both tables have statistics
+    HOSTS_INDEXES = {'irb': 'irb', 'ifl': 'ifl'}
+    HOSTS_ANALYZE_SQL = ('ANALYZE hosts', 'ANALYZE precheck_hosts')
+    SNAPSHOT_SQL = ('INSERT OR IGNORE INTO snapshots (name, stage, created) '
+                    'VALUES (?, ?, ?)')
+    GET_SNAPSHOT_SQL = 'SELECT snapshot_id FROM snapshots WHERE name=?'
+    SNAPSHOTS_SQL = 'SELECT snapshot_id, name, stage FROM snapshots'
+    LEGACY_TABLES_SQL = ('SELECT name FROM sqlite_master WHERE type=\'table\' '
+                         'AND (name GLOB \'precheck_[0-9]*\' '
+                         'OR name GLOB \'postcheck_[0-9]*\') ORDER BY name')
+    PRECHECK_VIEW_SQL = ('CREATE VIEW IF NOT EXISTS {view} AS SELECT '
+                         'addresses.ip as arp_ip, '
+                         'hosts.mac as arp_mac, '
+                         'hosts.irb as arp_irb, '
+                         'hosts.ifl as arp_ifl, '
+                         'precheck_hosts.ping as ping, '
+                         'precheck_hosts.ping_stage as ping_stage, '
+                         'precheck_hosts.rtt as rtt, '
+                         'precheck_hosts.loss as loss '
+                         'FROM precheck_hosts '
+                         'INNER JOIN hosts ON '
+                         'hosts.host_id = precheck_hosts.host_id '
+                         'INNER JOIN addresses ON '
+                         'addresses.address_id = hosts.address_id '
+                         'WHERE precheck_hosts.snapshot_id = {snapshot}')
+    POSTCHECK_VIEW_SQL = ('CREATE VIEW IF NOT EXISTS {view} AS SELECT '
+                          'probed.ip as ip, '
+                          'arp.ip as arp_ip, '
+                          'hosts.mac as arp_mac, '
+                          'hosts.irb as arp_irb, '
+                          'hosts.ifl as arp_ifl, '
+                          'postcheck_hosts.ping as ping, '
+                          'postcheck_hosts.ping_stage as ping_stage, '
+                          'postcheck_hosts.rtt as rtt, '
+                          'postcheck_hosts.loss as loss '
+                          'FROM postcheck_hosts '
+                          'LEFT JOIN addresses AS probed ON '
+                          'probed.address_id = postcheck_hosts.address_id '
+                          'LEFT JOIN hosts ON '
+                          'hosts.host_id = postcheck_hosts.host_id '
+                          'LEFT JOIN addresses AS arp ON '
+                          'arp.address_id = hosts.address_id '
+                          'WHERE postcheck_hosts.snapshot_id = {snapshot}')
+    ADDRESS_SQL = 'INSERT OR IGNORE INTO addresses (ip) VALUES (?1)'
+    HOST_SQL = ('INSERT OR IGNORE INTO hosts (address_id, mac, ifl, irb) '
+                'SELECT address_id, ?2, ?3, ?4 FROM addresses WHERE ip=?1')
+    MONITOR_FIELDS = ('ip text, '
+                      'sweep integer, '
+                      'ping text, '
+                      'PRIMARY KEY (ip, sweep)')
+    MONITOR_SWEEPS_FIELDS = ('sweep integer PRIMARY KEY, '
+                             'started real, '
+                             'finished real, '
+                             'probed integer, '
+                             'reachable integer')
+    MONITOR_SWEEPS_TABLE = '{}_sweeps'
+    PRECHECK_ARP_SQL = ('INSERT INTO precheck_hosts (snapshot_id, host_id) '
+                        'SELECT {snapshot}, host_id FROM hosts '
+                        'WHERE address_id = '
+                        '(SELECT address_id FROM addresses WHERE ip=?1) '
+                        'AND mac=?2 AND ifl=?3 AND irb=?4')
+    PRECHECK_PING_SQL = ('UPDATE precheck_hosts SET ping=?2, ping_stage=?3, '
+                         'rtt=?4, loss=?5 '
+                         'WHERE snapshot_id = {snapshot} AND ping is NULL '
+                         'AND host_id IN (SELECT host_id FROM hosts '
+                         'WHERE address_id = '
+                         '(SELECT address_id FROM addresses WHERE ip=?1))')
     GET_IP_SQL = 'SELECT DISTINCT arp_ip from {} '
     GET_PINGABLE_SQL = 'SELECT DISTINCT arp_ip FROM {} WHERE ping="OK"'
-    POSTCEHCK_PING_SQL = 'INSERT into {} (ip, ping) VALUES (:arp_ip, :ping)'
-    POST_UPDATE_ARP_SQL = ('UPDATE {db} SET '
-                           'arp_ip=:arp_ip, arp_mac=:arp_mac,'
-                           'arp_ifl=:arp_ifl, arp_irb=:arp_irb '
-                           'WHERE ip=:arp_ip ')
-    POST_INSERT_ARP_SQL = ('INSERT OR IGNORE INTO {db} '
-                           '(arp_ip, arp_mac, arp_ifl, arp_irb) '
-                           'SELECT :arp_ip, :arp_mac, :arp_ifl, :arp_irb '
-                           'WHERE NOT EXISTS '
-                           '(SELECT * from {db} where ip=:arp_ip or arp_ip=:arp_ip)')
+    # a resumed sweep skips the hosts which already have a stored result
+    RESUME_PRECHECK_SQL = 'ping IS NULL'
+    RESUME_POSTCHECK_SQL = ('arp_ip NOT IN '
+                            '(SELECT ip FROM {} WHERE ip IS NOT NULL)')
+    # postcheck hosts come from a precheck snapshot, so their
+    # addresses are always known
+    POSTCEHCK_PING_SQL = ('INSERT INTO postcheck_hosts '
+                          '(snapshot_id, address_id, ping, ping_stage, '
+                          'rtt, loss) '
+                          'SELECT {snapshot}, address_id, ?2, ?3, ?4, ?5 '
+                          'FROM addresses WHERE ip=?1')
+    # the postcheck ARP table is staged once and merged with set based
+    # statements, the probed row of an address takes the identity of its
+    # last ARP entry, an address nobody probed gets a row for its first
+    # entry unless the snapshot already holds one of its identities
+    POST_ARP_STAGE_SCRIPT = ('DROP TABLE IF EXISTS temp.arp_stage',
+                             'DROP TABLE IF EXISTS temp.arp_hosts',
+                             'CREATE TEMP TABLE arp_stage ('
+                             'seq integer PRIMARY KEY, '
+                             'ip text, mac text, ifl text, irb text)')
+    POST_ARP_STAGE_SQL = ('INSERT INTO temp.arp_stage (ip, mac, ifl, irb) '
+                          'VALUES (?, ?, ?, ?)')
+    POST_ARP_MERGE_SCRIPT = ('INSERT OR IGNORE INTO addresses (ip) '
+                             'SELECT ip FROM temp.arp_stage ORDER BY seq',
+                             'INSERT OR IGNORE INTO hosts '
+                             '(address_id, mac, ifl, irb) '
+                             'SELECT addresses.address_id, stage.mac, '
+                             'stage.ifl, stage.irb '
+                             'FROM temp.arp_stage AS stage '
+                             'INNER JOIN addresses ON '
+                             'addresses.ip = stage.ip ORDER BY stage.seq',
+                             'CREATE TEMP TABLE arp_hosts AS SELECT '
+                             'stage.seq as seq, '
+                             'hosts.address_id as address_id, '
+                             'hosts.host_id as host_id '
+                             'FROM temp.arp_stage AS stage '
+                             'INNER JOIN addresses ON '
+                             'addresses.ip = stage.ip '
+                             'INNER JOIN hosts ON '
+                             'hosts.address_id = addresses.address_id '
+                             'AND hosts.mac = stage.mac '
+                             'AND hosts.ifl = stage.ifl '
+                             'AND hosts.irb = stage.irb',
+                             'CREATE INDEX temp.arp_hosts_address_idx '
+                             'ON arp_hosts (address_id, seq)',
+                             'UPDATE postcheck_hosts SET host_id = '
+                             '(SELECT host_id FROM temp.arp_hosts '
+                             'WHERE address_id = postcheck_hosts.address_id '
+                             'ORDER BY seq DESC LIMIT 1) '
+                             'WHERE snapshot_id = {snapshot} '
+                             'AND address_id IN '
+                             '(SELECT address_id FROM temp.arp_hosts)',
+                             'INSERT INTO postcheck_hosts '
+                             '(snapshot_id, host_id) '
+                             'SELECT {snapshot}, arp.host_id '
+                             'FROM temp.arp_hosts AS arp '
+                             'WHERE arp.seq = (SELECT MIN(seq) '
+                             'FROM temp.arp_hosts '
+                             'WHERE address_id = arp.address_id) '
+                             'AND NOT EXISTS (SELECT 1 FROM postcheck_hosts '
+                             'WHERE snapshot_id = {snapshot} '
+                             'AND address_id = arp.address_id) '
+                             'AND NOT EXISTS (SELECT 1 FROM postcheck_hosts '
+                             'WHERE snapshot_id = {snapshot} AND host_id IN '
+                             '(SELECT known.host_id FROM hosts AS known '
+                             'WHERE known.address_id = arp.address_id)) '
+                             'ORDER BY arp.seq',
+                             'DROP TABLE temp.arp_hosts',
+                             'DROP TABLE temp.arp_stage')
     LOSTED_HOST_SQL = ('SELECT ' 
                        '{precheck}.arp_ip as pre_arp, '
                        '{precheck}.arp_mac as pre_mac, '
@@ -150,193 +1118,1159 @@ class Mwchecker(DBHandler):
                        'WHERE '
                        '{precheck}.ping = "OK" AND '
                        '{postcheck}.ping = "FAILED"')
-    COUNT_REACHABLE_SQL = ('SELECT COUNT (ping) '
-                           'as {parameter}_reachable '
-                           'FROM {table} WHERE ping="OK"')
-    COUNT_UNREACHABLE_SQL = ('SELECT COUNT (ping) '
-                             'as {parameter}_unreachable '
-                             'FROM {table} WHERE ping="FAILED"')
-    COUNT_ALL_ARP_SQL = ('SELECT DISTINCT COUNT (arp_ip) ' 
-                         'as {parameter}_arps FROM {table} '
-                         'WHERE ping IS NOT NULL ')
-    POST_ARP_UPSERT_SQL_SCRIPT = (POST_UPDATE_ARP_SQL,
-                                  POST_INSERT_ARP_SQL)
-    REPORT_PARAMETERS = (COUNT_REACHABLE_SQL,
-                         COUNT_UNREACHABLE_SQL,
-                         COUNT_ALL_ARP_SQL)
-
-    def __init__(self, router):
+    # one row per probed address with the result of every compared
+    # snapshot side by side, read in a single pass over both link tables;
+    # an address seen behind several hosts of a snapshot is represented
+    # by its best host row, so ping, rtt and loss come from the same probe
+    COMPARE_SQL = ('SELECT addresses.ip as ip, {columns} FROM ('
+                   'SELECT snapshot_id, address_id, ping, rtt, loss, '
+                   'ROW_NUMBER() OVER ('
+                   'PARTITION BY snapshot_id, address_id ORDER BY '
+                   'CASE ping WHEN \'OK\' THEN 0 WHEN \'FAILED\' THEN 1 '
+                   'ELSE 2 END, rtt IS NULL, rtt) as pick FROM ('
+                   'SELECT precheck_hosts.snapshot_id as snapshot_id, '
+                   'hosts.address_id as address_id, '
+                   'precheck_hosts.ping as ping, '
+                   'precheck_hosts.rtt as rtt, '
+                   'precheck_hosts.loss as loss '
+                   'FROM precheck_hosts INNER JOIN hosts ON '
+                   'hosts.host_id = precheck_hosts.host_id '
+                   'WHERE precheck_hosts.snapshot_id IN ({snapshots}) '
+                   'UNION ALL '
+                   'SELECT snapshot_id, address_id, ping, rtt, loss '
+                   'FROM postcheck_hosts '
+                   'WHERE snapshot_id IN ({snapshots}) '
+                   'AND address_id IS NOT NULL)) AS results '
+                   'INNER JOIN addresses ON '
+                   'addresses.address_id = results.address_id '
+                   'WHERE results.pick = 1 '
+                   'GROUP BY results.address_id '
+                   'ORDER BY addresses.ip')
+    COMPARE_COLUMN_SQL = ('MAX(CASE WHEN snapshot_id = {snapshot} '
+                          'THEN {field} END)')
+    COMPARE_FIELDS = ('ping', 'rtt', 'loss')
+    STAGE_STATS_SQL = ('SELECT '
+                       'COUNT(CASE WHEN ping=\'OK\' THEN 1 END) '
+                       'as {stage}_reachable, '
+                       'COUNT(CASE WHEN ping=\'FAILED\' THEN 1 END) '
+                       'as {stage}_unreachable, '
+                       'COUNT(CASE WHEN ping IS NOT NULL THEN arp_ip END) '
+                       'as {stage}_arps '
+                       'FROM {table}')
+    MONITOR_CHANGE_SQL = 'INSERT INTO {} (ip, sweep, ping) VALUES (?, ?, ?)'
+    MONITOR_SWEEP_SQL = ('INSERT INTO {} '
+                         '(sweep, started, finished, probed, reachable) '
+                         'VALUES (?, ?, ?, ?, ?)')
+    MONITOR_LAST_SWEEP_SQL = 'SELECT COALESCE(MAX(sweep), 0) FROM {}'
+    MONITOR_STATE_SQL = ('SELECT ip, ping FROM {table} AS state '
+                         'WHERE sweep = (SELECT MAX(sweep) FROM {table} '
+                         'WHERE ip = state.ip)')
+    MONITOR_STATS_SQL = ('SELECT '
+                         'COUNT(*) as monitor_sweeps, '
+                         'MAX(probed) as monitor_hosts, '
+                         'ROUND(MAX(finished) - MIN(started)) '
+                         'as monitor_seconds, '
+                         'ROUND(MAX(finished - started), 1) '
+                         'as slowest_sweep_seconds, '
+                         '(SELECT COUNT(*) FROM {table} '
+                         'WHERE ping=\'FAILED\') as outages, '
+                         '(SELECT COUNT(DISTINCT ip) FROM {table} '
+                         'WHERE ping=\'FAILED\') as hosts_with_outages '
+                         'FROM {sweeps}')
+    MONITOR_OUTAGES_SQL = ('SELECT ip, '
+                           'datetime(outage_start, \'unixepoch\', '
+                           '\'localtime\') as outage_start, '
+                           'datetime(outage_end, \'unixepoch\', '
+                           '\'localtime\') as outage_end, '
+                           'ROUND(COALESCE(outage_end, last_seen) - '
+                           'outage_start, 1) as duration '
+                           'FROM (SELECT '
+                           '{table}.ip as ip, '
+                           '{table}.ping as ping, '
+                           '{sweeps}.started as outage_start, '
+                           'LEAD({sweeps}.started) OVER ('
+                           'PARTITION BY {table}.ip ORDER BY {table}.sweep) '
+                           'as outage_end, '
+                           '(SELECT MAX(finished) FROM {sweeps}) as last_seen '
+                           'FROM {table} '
+                           'INNER JOIN {sweeps} ON '
+                           '{table}.sweep = {sweeps}.sweep) '
+                           'WHERE ping = \'FAILED\' '
+                           'ORDER BY ip, outage_start')
+    HOST_INTERFACES_SQL = 'SELECT arp_ip, arp_irb, arp_ifl FROM {}'
+    PRECHECK_INDEXES = {'ping': 'ping, arp_ip'}
+    POSTCHECK_INDEXES = {'ping': 'ping, ip',
+                         'arp_ip': 'arp_ip'}
+    MIGRATE_ADDRESSES_SQL = ('INSERT OR IGNORE INTO addresses (ip) '
+                             'SELECT {column} FROM {table} '
+                             'WHERE {column} IS NOT NULL')
+    MIGRATE_HOSTS_SQL = ('INSERT OR IGNORE INTO hosts '
+                         '(address_id, mac, ifl, irb) '
+                         'SELECT addresses.address_id, '
+                         'arp_mac, arp_ifl, arp_irb FROM {table} '
+                         'INNER JOIN addresses ON '
+                         'addresses.ip = {table}.arp_ip')
+    MIGRATE_PRECHECK_SQL = ('INSERT OR IGNORE INTO precheck_hosts '
+                            '(snapshot_id, host_id, ping, ping_stage) '
+                            'SELECT {snapshot}, hosts.host_id, '
+                            'ping, ping_stage FROM {table} '
+                            'INNER JOIN addresses ON '
+                            'addresses.ip = {table}.arp_ip '
+                            'INNER JOIN hosts ON '
+                            'hosts.address_id = addresses.address_id '
+                            'AND hosts.mac IS {table}.arp_mac '
+                            'AND hosts.irb IS {table}.arp_irb '
+                            'AND hosts.ifl IS {table}.arp_ifl')
+    MIGRATE_POSTCHECK_SQL = ('INSERT INTO postcheck_hosts '
+                             '(snapshot_id, address_id, host_id, '
+                             'ping, ping_stage) '
+                             'SELECT {snapshot}, probed.address_id, '
+                             'hosts.host_id, ping, ping_stage FROM {table} '
+                             'LEFT JOIN addresses AS probed ON '
+                             'probed.ip = {table}.ip '
+                             'LEFT JOIN addresses AS arp ON '
+                             'arp.ip = {table}.arp_ip '
+                             'LEFT JOIN hosts ON '
+                             'hosts.address_id = arp.address_id '
+                             'AND hosts.mac IS {table}.arp_mac '
+                             'AND hosts.irb IS {table}.arp_irb '
+                             'AND hosts.ifl IS {table}.arp_ifl')
+    MIGRATE_COUNT_SQL = ('SELECT (SELECT COUNT(*) FROM {table}), '
+                         '(SELECT COUNT(*) FROM {stage}_hosts '
+                         'WHERE snapshot_id = {snapshot})')
+
+    def __init__(self, router, ping_backend=PING_BACKEND,
+                 ping_count=PING_COUNT, ping_timeout=PING_TIMEOUT,
+                 ping_concurrency=PING_CONCURRENCY, ping_rate=PING_RATE,
+                 ping_adaptive=False, sweep_timeout=SWEEP_TIMEOUT,
+                 confirm_rounds=CONFIRM_ROUNDS,
+                 router_sessions=ROUTER_SESSIONS, cache_ttl=CACHE_TTL,
+                 cache_retention=CACHE_RETENTION, force_probe=False,
+                 metrics=None, **db_options):
+        super().__init__('db_{}.db'.format(router), **db_options)
         self.router = router
-        self.dbname = 'db_{}.db'.format(router)
+        self.session = None
+        self.session_login = None
+        self.login = None
+        self.ping_source = None
+        self.metrics = metrics or Metrics()
+        self.set_ping_options(ping_backend=ping_backend,
+                              ping_count=ping_count,
+                              ping_timeout=ping_timeout,
+                              ping_concurrency=ping_concurrency,
+                              ping_rate=ping_rate,
+                              ping_adaptive=ping_adaptive,
+                              sweep_timeout=sweep_timeout,
+                              confirm_rounds=confirm_rounds,
+                              router_sessions=router_sessions,
+                              cache_ttl=cache_ttl,
+                              cache_retention=cache_retention,
+                              force_probe=force_probe)
+
+    def set_ping_options(self, ping_backend=PING_BACKEND,
+                         ping_count=PING_COUNT, ping_timeout=PING_TIMEOUT,
+                         ping_concurrency=PING_CONCURRENCY,
+                         ping_rate=PING_RATE, ping_adaptive=False,
+                         sweep_timeout=SWEEP_TIMEOUT,
+                         confirm_rounds=CONFIRM_ROUNDS,
+                         router_sessions=ROUTER_SESSIONS, cache_ttl=CACHE_TTL,
+                         cache_retention=CACHE_RETENTION, force_probe=False):
+        self.ping_backend = ping_backend
+        self.ping_count = ping_count
+        self.ping_timeout = ping_timeout
+        self.ping_concurrency = ping_concurrency
+        self.ping_rate = ping_rate
+        self.ping_adaptive = ping_adaptive
+        self.sweep_timeout = sweep_timeout
+        self.confirm_rounds = max(1, confirm_rounds)
+        self.router_sessions = max(1, router_sessions)
+        self.cache_ttl = cache_ttl
+        self.cache_retention = max(cache_retention, cache_ttl)
+        self.force_probe = force_probe
+
+    def set_login(self, username, password, port=22):
+        self.login = {'username': username,
+                      'password': password,
+                      'port': port}
 
     def init_precheck_database(self, table_name):
-        super().create_table(table_name, self.PRECHECK_FIELDS)
+        self.init_snapshot(table_name, 'precheck')
 
     def init_postcheck_database(self, table_name):
-        super().create_table(table_name, self.POSTCHECK_FIELDS)
+        self.init_snapshot(table_name, 'postcheck')
+
+    def init_snapshot_storage(self):
+        super().create_table('addresses', self.ADDRESSES_FIELDS)
+        super().create_table('hosts', self.HOSTS_FIELDS)
+        super().create_table('snapshots', self.SNAPSHOTS_FIELDS)
+        super().create_table('precheck_hosts', self.PRECHECK_HOSTS_FIELDS,
+                             'WITHOUT ROWID')
+        super().create_table('postcheck_hosts', self.POSTCHECK_HOSTS_FIELDS)
+        self.create_indexes('postcheck_hosts', self.POSTCHECK_HOSTS_INDEXES)
+        super().create_table('probe_cache', self.PROBE_CACHE_FIELDS)
+        added = []
+        for table in ('precheck_hosts', 'postcheck_hosts'):
+            added += self.add_columns(table, self.MEASURE_COLUMNS) or []
+        if added:
+            self.refresh_views()
+
+    def refresh_views(self):
+        # views keep the columns they were created with
+        try:
+            with self.transaction() as con:
+                for snapshot, name, stage in con.execute(
+                        self.SNAPSHOTS_SQL).fetchall():
+                    view_sql = {'precheck': self.PRECHECK_VIEW_SQL,
+                                'postcheck': self.POSTCHECK_VIEW_SQL}[stage]
+                    con.execute('DROP VIEW IF EXISTS {}'.format(name))
+                    con.execute(view_sql.format(view=name, snapshot=snapshot))
+        except sqlite3.Error as error:
+            logger.error(error, exc_info=True)
+            raise MwcheckerError(error)
+
+    def init_snapshot(self, name, stage):
+        # every snapshot shares the hosts table and is read through a view
+        # named like the per-ID tables of older versions
+        legacy_tables = self.get_legacy_tables()
+        if legacy_tables:
+            raise MwcheckerError(
+                '{} keeps {} in the per-table format of older versions, '
+                'run migrate first'.format(self.dbname,
+                                           ', '.join(legacy_tables)))
+        self.init_snapshot_storage()
+        self.execute(self.SNAPSHOT_SQL,
+                     (name, stage, dt.datetime.now().isoformat(' ', 'seconds')))
+        view_sql = {'precheck': self.PRECHECK_VIEW_SQL,
+                    'postcheck': self.POSTCHECK_VIEW_SQL}[stage]
+        self.execute(view_sql.format(view=name,
+                                     snapshot=self.get_snapshot_id(name)))
+
+    def get_snapshot_id(self, name):
+        rows = self.execute(self.GET_SNAPSHOT_SQL, (name,))
+        if not rows:
+            raise MwcheckerError('unknown snapshot {}'.format(name))
+        return rows[0][0]
+
+    def get_legacy_tables(self):
+        return [row[0] for row in self.iterate(self.LEGACY_TABLES_SQL)]
+
+    def migrate_snapshots(self):
+        legacy_tables = self.get_legacy_tables()
+        if not legacy_tables:
+            print('{}: {} has nothing to migrate'.format(self.ttime(),
+                                                         self.dbname))
+            return 0
+        size = os.path.getsize(self.dbname)
+        self.init_snapshot_storage()
+        for table in legacy_tables:
+            # tables written before ping_stage existed lack the column
+            self.add_columns(table, self.PING_COLUMNS)
+            self.migrate_table(table)
+        con = self.get_connection()
+        con.execute('VACUUM')
+        con.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        print('{}: {} migrated {} tables, {} -> {} bytes'.format(
+            self.ttime(), self.dbname, len(legacy_tables), size,
+            os.path.getsize(self.dbname)))
+        return len(legacy_tables)
+
+    def migrate_table(self, table):
+        stage = table.split('_', 1)[0]
+        columns = {'precheck': ('arp_ip',),
+                   'postcheck': ('ip', 'arp_ip')}[stage]
+        migrate_sql = {'precheck': self.MIGRATE_PRECHECK_SQL,
+                       'postcheck': self.MIGRATE_POSTCHECK_SQL}[stage]
+        view_sql = {'precheck': self.PRECHECK_VIEW_SQL,
+                    'postcheck': self.POSTCHECK_VIEW_SQL}[stage]
+        try:
+            with self.transaction() as con:
+                con.execute(self.SNAPSHOT_SQL,
+                            (table, stage,
+                             dt.datetime.now().isoformat(' ', 'seconds')))
+                snapshot = con.execute(self.GET_SNAPSHOT_SQL,
+                                       (table,)).fetchone()[0]
+                for column in columns:
+                    con.execute(self.MIGRATE_ADDRESSES_SQL.format(
+                        table=table, column=column))
+                con.execute(self.MIGRATE_HOSTS_SQL.format(table=table))
+                con.execute(migrate_sql.format(table=table,
+                                               snapshot=snapshot))
+                rows, migrated = con.execute(self.MIGRATE_COUNT_SQL.format(
+                    table=table, stage=stage, snapshot=snapshot)).fetchone()
+                if rows != migrated:
+                    raise MwcheckerError(
+                        '{}: {} rows, {} migrated'.format(table, rows,
+                                                          migrated))
+                con.execute('DROP TABLE {}'.format(table))
+                con.execute(view_sql.format(view=table, snapshot=snapshot))
+        except sqlite3.Error as error:
+            logger.error(error, exc_info=True)
+            raise MwcheckerError(error)
+        print('{}: {} migrated, {} rows'.format(self.ttime(), table, rows))
+
+    def init_monitor_database(self, table_name):
+        super().create_table(table_name, self.MONITOR_FIELDS)
+        super().create_table(self.MONITOR_SWEEPS_TABLE.format(table_name),
+                             self.MONITOR_SWEEPS_FIELDS)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['session'] = None
+        state['session_login'] = None
+        return state
 
     def fetch_precheck_arp(self, username, password,
-                           destination_table, port=22):
+                           destination_table, port=22, irb=None):
+        from_box_data = self.get_frombox_data(username=username,
+                                              password=password,
+                                              port=port,
+                                              interface=self.get_arp_filter(irb))
+        with self.metrics.phase('arp_store') as span:
+            arp_entries = self.iter_arp(input_xml=from_box_data['arp'],
+                                        span=span)
+            self.store_precheck_arp(destination_table, arp_entries)
+
+    def fetch_precheck_arp_tables(self, username, password, tables, port=22):
+        # a single fetch of the whole ARP table feeds every precheck table
         from_box_data = self.get_frombox_data(username=username,
                                               password=password,
                                               port=port)
-        arp_entries = self.parse_arp(input_xml=from_box_data['arp'])
-        sql_querry = self.PRECHECK_ARP_SQL.format(destination_table)
-        self.execute_many(sql_querry, arp_entries)
+        with self.metrics.phase('arp_store') as span:
+            arp_entries = self.iter_arp(input_xml=from_box_data['arp'],
+                                        span=span)
+            self.store_precheck_arp_tables(
+                {table: self.get_arp_matcher(arp_filter.irb, arp_filter.ifl)
+                 for table, arp_filter in tables.items()}, arp_entries)
+
+    def store_precheck_arp(self, table, arp_entries):
+        self.store_precheck_arp_tables({table: None}, arp_entries)
+
+    def store_precheck_arp_tables(self, tables, arp_entries):
+        # every entry is stored once and linked to the snapshot of each
+        # table whose filters it matches, None matches everything
+        query_list = [self.HOST_SQL]
+        matchers = [None]
+        for table, matcher in tables.items():
+            query_list.append(self.PRECHECK_ARP_SQL.format(
+                snapshot=self.get_snapshot_id(table)))
+            matchers.append(matcher)
+        if None not in matchers[1:]:
+            arp_entries = (entry for entry in arp_entries
+                           if any(matcher(entry) for matcher in matchers[1:]))
+        self.store_arp(query_list, arp_entries, matchers)
+
+    def store_arp(self, query_list, arp_entries, matchers=()):
+        # entries are read in bounded chunks, each chunk registers its
+        # addresses and then runs every query over the whole chunk, or
+        # over the entries accepted by the matcher of that query
+        arp_entries = iter(arp_entries)
+        try:
+            with self.transaction() as con:
+                while True:
+                    batch = list(itertools.islice(arp_entries,
+                                                  self.ARP_BATCH_SIZE))
+                    if not batch:
+                        break
+                    con.executemany(self.ADDRESS_SQL,
+                                    ((entry.arp_ip,) for entry in batch))
+                    for querry, matcher in itertools.zip_longest(query_list,
+                                                                 matchers):
+                        con.executemany(querry, batch if matcher is None else
+                                        [entry for entry in batch
+                                         if matcher(entry)])
+        except sqlite3.IntegrityError as error:
+            logger.error(error, exc_info=True)
+            raise MwcheckerError(error)
+        except sqlite3.Error as error:
+            logger.error(error, exc_info=True)
 
     def fetch_postcheck_arp(self, username, password,
                             destination_table, port=22):
         from_box_data = self.get_frombox_data(username=username,
                                               password=password,
                                               port=port)
-        arp_entries = self.parse_arp(input_xml=from_box_data['arp'])
-        query_list = []
-        for querry in self.POST_ARP_UPSERT_SQL_SCRIPT:
-            query_list.append(querry.format(db=destination_table))
-        self.execute_many_scripts(query_list, arp_entries)
+        with self.metrics.phase('arp_store') as span:
+            arp_entries = self.iter_arp(input_xml=from_box_data['arp'],
+                                        span=span)
+            self.store_postcheck_arp(destination_table, arp_entries)
 
-    def fetch_precheck_pings(self, table, irb=None, ifl=None):
+    def store_postcheck_arp(self, table, arp_entries):
+        snapshot = self.get_snapshot_id(table)
+        try:
+            with self.transaction() as con:
+                for querry in self.POST_ARP_STAGE_SCRIPT:
+                    con.execute(querry)
+                con.executemany(self.POST_ARP_STAGE_SQL, arp_entries)
+                for querry in self.POST_ARP_MERGE_SCRIPT:
+                    con.execute(querry.format(snapshot=snapshot))
+        except sqlite3.Error as error:
+            logger.error(error, exc_info=True)
+            raise MwcheckerError(error)
+
+    def fetch_precheck_pings(self, table, irb=None, ifl=None, resume=False):
+        return self.fetch_pings(*self.get_precheck_pings_sql(table, irb, ifl,
+                                                             resume))
+
+    def fetch_precheck_pings_tables(self, tables, resume=False):
+        return self.fetch_shared_pings(
+            {table: self.get_precheck_pings_sql(table, arp_filter.irb,
+                                                arp_filter.ifl, resume)
+             for table, arp_filter in tables.items()})
+
+    def fetch_postcheck_pings(self, source_table, destination_table,
+                              resume=False):
+        return self.fetch_pings(*self.get_postcheck_pings_sql(
+            source_table, destination_table, resume))
+
+    def get_precheck_pings_sql(self, table, irb=None, ifl=None, resume=False):
+        self.ping_source = table
         source_sql = self.GET_IP_SQL.format(table)
-        conditions_sql = self.get_conditions_sql(arp_irb=irb, arp_ifl=ifl)
+        conditions_sql, parameters = self.get_conditions(arp_irb=irb,
+                                                         arp_ifl=ifl)
+        if parameters:
+            self.index_hosts()
+        if resume:
+            conditions_sql = ' AND '.join(filter(None, (
+                conditions_sql, self.RESUME_PRECHECK_SQL)))
         if conditions_sql:
             source_sql += ' WHERE {} '.format(conditions_sql)
-        dest_sql = self.PRECHECK_PING_SQL.format(table)
-        self.fetch_pings(source_sql, dest_sql)
+        dest_sql = self.PRECHECK_PING_SQL.format(
+            snapshot=self.get_snapshot_id(table))
+        return source_sql, dest_sql, parameters
 
-    def fetch_postcheck_pings(self, source_table, destination_table):
+    def get_postcheck_pings_sql(self, source_table, destination_table,
+                                resume=False):
+        self.ping_source = source_table
         source_sql = self.GET_IP_SQL.format(source_table)
-        dest_sql = self.POSTCEHCK_PING_SQL.format(destination_table)
-        conditions_sql = self.get_conditions_sql(ping='OK')
+        dest_sql = self.POSTCEHCK_PING_SQL.format(
+            snapshot=self.get_snapshot_id(destination_table))
+        conditions_sql, parameters = self.get_conditions(ping='OK')
+        if resume:
+            conditions_sql = ' AND '.join(filter(None, (
+                conditions_sql,
+                self.RESUME_POSTCHECK_SQL.format(destination_table))))
         if conditions_sql:
             source_sql += ' WHERE {} '.format(conditions_sql)
-        self.fetch_pings(source_sql, dest_sql)
+        return source_sql, dest_sql, parameters
+
+    def index_hosts(self):
+        if self.get_object_type('hosts_irb_idx') is not None:
+            return
+        self.create_indexes('hosts', self.HOSTS_INDEXES)
+        for querry in self.HOSTS_ANALYZE_SQL:
+            self.execute(querry)
+
+    def fetch_shared_pings(self, jobs):
+        # an address listed by several tables is probed once and its
+        # result written to each of them
+        targets = {}
+        writers = {}
+        self.resolve_ping_backend()
+        for label, (source_sql, dest_sql, parameters) in jobs.items():
+            hosts_list = self.get_ip_address(source_sql, parameters)
+            writers[label] = self.get_ping_writer(dest_sql,
+                                                  total=len(hosts_list),
+                                                  label=label)
+            for host in hosts_list:
+                targets.setdefault(host, []).append(writers[label])
+        cached, hosts_list = self.get_cached_pings(list(targets))
+        for ping in cached:
+            for writer in targets[ping.arp_ip]:
+                writer.add(ping, cache=False)
+        print('{}: Starting to ping {} hosts of {} tables connected to '
+              'router {}'.format(self.ttime(), len(hosts_list), len(writers),
+                                 self.router))
+        probed = reachable = 0
+        with self.metrics.phase('ping_sweep'):
+            try:
+                for ping in self.get_pings_runner(hosts_list):
+                    probed += 1
+                    reachable += ping.ping == 'OK'
+                    for index, writer in enumerate(targets[ping.arp_ip]):
+                        writer.add(ping, cache=not index)
+            except KeyboardInterrupt:
+                for writer in writers.values():
+                    writer.close()
+                self.print_interrupted(sum(writer.written
+                                           for writer in writers.values()))
+                raise
+            for writer in writers.values():
+                writer.close()
+        self.metrics.count('hosts_probed', probed)
+        self.metrics.count('hosts_reachable', reachable)
+        self.metrics.count('hosts_unreachable', probed - reachable)
+        self.count_cache(len(cached), len(hosts_list))
+        return writers
+
+    def fetch_pings(self, source_sql, dest_sql, parameters=()):
+        hosts_list = self.get_ip_address(source_sql, parameters)
+        self.resolve_ping_backend()
+        writer = self.get_ping_writer(dest_sql, total=len(hosts_list))
+        cached, hosts_list = self.get_cached_pings(hosts_list)
+        for ping in cached:
+            writer.add(ping, cache=False)
+        print('{}: Starting to ping {} hosts connected to '
+              'router {}'.format(self.ttime(), len(hosts_list), self.router))
+        with self.metrics.phase('ping_sweep'):
+            try:
+                for ping in self.get_pings_runner(hosts_list):
+                    writer.add(ping)
+            except KeyboardInterrupt:
+                # every committed batch is a checkpoint for --resume
+                writer.close()
+                self.print_interrupted(writer.written)
+                raise
+            writer.close()
+        self.count_pings(writer)
+        self.count_cache(len(cached), len(hosts_list))
+        return writer
+
+    def get_cached_pings(self, hosts_list):
+        # fresh results of earlier sweeps stand in for a probe, only the
+        # other hosts are left to probe
+        self.execute(self.CACHE_EVICT_SQL, (self.cache_retention,))
+        if not self.cache_ttl or self.force_probe:
+            return [], hosts_list
+        fresh = {row[0]: PingResult(*row) for row in self.iterate(
+            self.CACHE_FRESH_SQL, (self.ping_backend, self.cache_ttl))}
+        cached = []
+        missed = HostList()
+        for host in hosts_list:
+            if host in fresh:
+                cached.append(fresh[host])
+            else:
+                missed.append(host)
+        return cached, missed
+
+    def count_cache(self, hits, misses):
+        self.metrics.count('probe_cache_hits', hits)
+        self.metrics.count('probe_cache_misses', misses)
+        if self.cache_ttl:
+            print('{}: Probe cache of router {}: {} hits, {} misses'.format(
+                self.ttime(), self.router, hits, misses))
+
+    @classmethod
+    def print_interrupted(cls, written):
+        print('{}: Interrupted, {} results are stored, run the same task '
+              'with --resume to ping the remaining hosts'.format(cls.ttime(),
+                                                                written))
+
+    def count_pings(self, writer):
+        self.metrics.count('hosts_probed', writer.written)
+        self.metrics.count('hosts_reachable', writer.reachable)
+        self.metrics.count('hosts_unreachable', writer.unreachable)
+
+    def get_ping_writer(self, dest_sql, total, label=''):
+        return PingWriter(self, dest_sql, total, label=label,
+                          batch_size=self.WRITE_BATCH_SIZE,
+                          batch_interval=self.WRITE_BATCH_INTERVAL,
+                          metrics=self.metrics,
+                          cache_sql=self.CACHE_STORE_SQL.format(
+                              backend=self.ping_backend))
 
-    def fetch_pings(self, source_sql, dest_sql):
-        hosts_list = self.get_ip_address(source_sql)
-        pings = self.get_pings_runner(hosts_list)
-        self.execute_many(dest_sql, pings)
+    def monitor(self, source_table, table, interval=MONITOR_INTERVAL,
+                sweeps=None, duration=None):
+        self.ping_source = source_table
+        hosts_list = self.get_ip_address(
+            self.GET_PINGABLE_SQL.format(source_table))
+        if not len(hosts_list):
+            raise MwcheckerError(
+                'no reachable hosts in {}'.format(source_table))
+        # a resumed run carries on from the last stored state of every host
+        states = {row['ip']: row['ping'] for row in
+                  self.iterate(self.MONITOR_STATE_SQL.format(table=table))}
+        sweep = self.execute(self.MONITOR_LAST_SWEEP_SQL.format(
+            self.MONITOR_SWEEPS_TABLE.format(table)))[0][0]
+        # every host costs ping_count probes, an adaptive sweep settles
+        # most of them with its single probe first pass
+        probes = len(hosts_list) * (1 if self.ping_adaptive
+                                    else self.ping_count)
+        if self.ping_rate and probes / self.ping_rate > interval:
+            print('{}: {} probes at {} probes/s take longer than the {}s '
+                  'interval'.format(self.ttime(), probes, self.ping_rate,
+                                    interval))
+        print('{}: Monitoring {} hosts of router {} every {}s'.format(
+            self.ttime(), len(hosts_list), self.router, interval))
+        started = time.monotonic()
+        next_sweep = started
+        done = 0
+        try:
+            while sweeps is None or done < sweeps:
+                if duration is not None and next_sweep - started >= duration:
+                    break
+                wait = next_sweep - time.monotonic()
+                if wait > 0:
+                    sleep(wait)
+                sweep += 1
+                self.monitor_sweep(hosts_list, table, sweep, states)
+                done += 1
+                next_sweep += interval
+                if time.monotonic() > next_sweep:
+                    logger.warning('%s: sweep %s overran the %ss interval',
+                                   self.router, sweep, interval)
+                    self.metrics.count('monitor_overruns')
+                    next_sweep = time.monotonic()
+        except KeyboardInterrupt:
+            print('{}: Monitoring stopped after {} sweeps'.format(
+                self.ttime(), done))
+        return done
+
+    def monitor_sweep(self, hosts_list, table, sweep, states):
+        # only the first sweep and state changes are stored, a steady
+        # host costs one row for the whole window
+        started = time.time()
+        changes = []
+        probed = 0
+        reachable = 0
+        with self.metrics.phase('monitor_sweep'):
+            for ping in self.get_pings_runner(hosts_list):
+                probed += 1
+                if ping.ping == 'OK':
+                    reachable += 1
+                if states.get(ping.arp_ip) != ping.ping:
+                    states[ping.arp_ip] = ping.ping
+                    changes.append((ping.arp_ip, sweep, ping.ping))
+            finished = time.time()
+            try:
+                with self.transaction() as con:
+                    con.execute(self.MONITOR_SWEEP_SQL.format(
+                        self.MONITOR_SWEEPS_TABLE.format(table)),
+                        (sweep, started, finished, probed, reachable))
+                    con.executemany(self.MONITOR_CHANGE_SQL.format(table),
+                                    changes)
+            except sqlite3.Error as error:
+                logger.error(error, exc_info=True)
+                raise MwcheckerError(error)
+        self.metrics.count('monitor_sweeps')
+        self.metrics.count('monitor_state_changes', len(changes))
+        print('{}: sweep {}: {} hosts probed in {:.1f}s, {} OK, {} FAILED, '
+              '{} changed state'.format(self.ttime(), sweep, probed,
+                                        finished - started, reachable,
+                                        probed - reachable, len(changes)))
 
     def get_pings_runner(self, hosts_lists, workers=WORKERS_NUMBER):
-        print('{}: Starting to ping hosts connected to '
-              'router {}'.format(self.ttime(), self.router))
+        if self.ping_adaptive:
+            return self.adaptive_pings_runner(hosts_lists, workers)
+        return self.get_probe_runner(hosts_lists, self.ping_count,
+                                     self.ping_timeout, workers)
+
+    def adaptive_pings_runner(self, hosts_lists, workers=WORKERS_NUMBER):
+        # a single short probe settles most hosts, only the silent ones
+        # are retried with full probes and a growing timeout
+        pings = self.get_probe_runner(hosts_lists, 1,
+                                      self.sweep_timeout, workers)
+        unanswered = []
+        for ping in self.set_stage(pings, 'sweep'):
+            if ping.ping == 'OK':
+                yield ping
+            else:
+                unanswered.append(ping.arp_ip)
+        for confirm_round in range(self.confirm_rounds):
+            if not unanswered:
+                break
+            print('{}: Confirming {} unanswered hosts, round {}'.format(
+                self.ttime(), len(unanswered), confirm_round + 1))
+            self.metrics.count('hosts_confirmed', len(unanswered))
+            last_round = confirm_round == self.confirm_rounds - 1
+            timeout = self.ping_timeout * 2 ** confirm_round
+            pings = self.get_probe_runner(unanswered, self.ping_count,
+                                          timeout, workers)
+            unanswered = []
+            for ping in self.set_stage(pings, 'confirm'):
+                if ping.ping == 'OK' or last_round:
+                    yield ping
+                else:
+                    unanswered.append(ping.arp_ip)
+
+    def get_probe_runner(self, hosts_lists, count, timeout,
+                         workers=WORKERS_NUMBER):
+        if self.ping_backend == 'router':
+            return self.router_pings_runner(hosts_lists, count, timeout)
+        if self.ping_backend == 'icmp':
+            pinger = self.get_icmp_pinger(count, timeout)
+            if pinger is not None:
+                return self.icmp_pings_runner(pinger, hosts_lists)
+        worker = partial(self.pinger_worker, count=count, timeout=timeout)
         if len(hosts_lists) // workers >= 2:
-            with Pool(workers) as p:
-                ping_results = p.map(self.pinger_worker, hosts_lists)
-        else:
-            ping_results = map(self.pinger_worker, hosts_lists)
-        return ping_results
+            return self.pool_pings_runner(worker, hosts_lists, workers)
+        return map(worker, hosts_lists)
+
+    def get_icmp_pinger(self, count, timeout):
+        try:
+            return IcmpPinger(count=count,
+                              timeout=timeout,
+                              concurrency=self.ping_concurrency,
+                              rate=self.ping_rate,
+                              metrics=self.metrics)
+        except MwcheckerError as error:
+            logger.warning('ICMP sockets are unavailable, '
+                           'falling back to ping subprocess: %s', error)
+            print('{}: ICMP sockets are unavailable ({}), falling back '
+                  'to ping subprocess'.format(self.ttime(), error))
+            self.ping_backend = 'subprocess'
+
+    def resolve_ping_backend(self):
+        # the fallback is settled before a sweep, so the probe cache is
+        # read and written under the backend that really probes
+        if self.ping_backend == 'icmp':
+            pinger = self.get_icmp_pinger(self.ping_count, self.ping_timeout)
+            if pinger is not None:
+                pinger.close()
+        return self.ping_backend
 
-    def pinger_worker(self, host):
-        ping_task = self.PING_COMMAND.format(host)
+    @staticmethod
+    def set_stage(pings, stage):
+        for ping in pings:
+            yield ping._replace(ping_stage=stage)
+
+    @staticmethod
+    def pool_pings_runner(worker, hosts_lists, workers):
+        # one host per task, so every result streams to the writer as
+        # soon as its ping returns
+        with multiprocessing.Pool(workers) as p:
+            yield from p.imap_unordered(worker, hosts_lists)
+
+    @staticmethod
+    def icmp_pings_runner(pinger, hosts_lists):
+        with pinger:
+            yield from pinger.ping_many(hosts_lists)
+
+    def router_pings_runner(self, hosts_lists, count, timeout):
+        if self.login is None:
+            raise MwcheckerError('router backend needs the router login')
+        pinger = RouterPinger(partial(self.connect, **self.login),
+                              self.get_host_interfaces(),
+                              count=count,
+                              timeout=timeout,
+                              sessions=self.router_sessions,
+                              metrics=self.metrics)
+        with pinger:
+            yield from pinger.ping_many(hosts_lists)
+
+    def get_host_interfaces(self):
+        # the ARP table the hosts are pinged from says where each one is
+        # learned now, older snapshots may still place it elsewhere
+        interfaces = {}
+        if self.ping_source is None:
+            return interfaces
+        for ip, irb, ifl in self.iterate(
+                self.HOST_INTERFACES_SQL.format(self.ping_source)):
+            interfaces.setdefault(ip, irb if irb and irb != 'n_a' else ifl)
+        return interfaces
+
+    def pinger_worker(self, host, count=PING_COUNT, timeout=PING_TIMEOUT):
+        # older iputils only accept whole seconds as a deadline
+        ping_task = self.PING_COMMAND.format(host=host,
+                                             count=count,
+                                             timeout=max(1, ceil(timeout)))
         print(ping_task)
         ping_output = os.popen(ping_task).read()
-        ping_result = self.response_checker(ping_output, host)
-        return {'arp_ip': host,
-                'ping': ping_result}
+        return self.response_checker(ping_output, host, count)
 
-    def response_checker(self, output, host):
+    def response_checker(self, output, host, count=PING_COUNT):
         host_pattern = re.compile(self.PING_PATTERN_STR.format(host))
+        # duplicated replies share the icmp_seq of the first one
+        round_trips = {}
         for found in host_pattern.finditer(output):
-            if found:
-                return "OK"
-        return "FAILED"
+            round_trips.setdefault(
+                found.group('sequence'),
+                float(found.group('time').replace(',', '.')))
+        return self.get_ping_result(host, count, list(round_trips.values()))
+
+    @staticmethod
+    def get_ping_result(host, count, round_trips):
+        # rtt is the mean of the answered echo requests in milliseconds,
+        # loss the share of unanswered ones in percent
+        if not round_trips:
+            return PingResult(host, 'FAILED', loss=100.0)
+        received = min(len(round_trips), count)
+        return PingResult(host, 'OK',
+                          rtt=round(sum(round_trips) / len(round_trips), 3),
+                          loss=round(100 * (count - received) / count, 1))
 
-    def get_frombox_data(self, username, password, port=22):
-        print('{}: Connecting to router {}'.format(self.ttime(), self.router))
+    def get_frombox_data(self, username, password, port=22, interface=None):
         response = {}
-        with manager.connect(host=self.router,
-                             port=port,
-                             username=username,
-                             password=password,
-                             hostkey_verify=False,
-                             device_params={'name': 'junos'}) as mgr:
-            sleep(1)
-            for task, rpc_querry in self.OUTPUT_TASKS.items():
-                response[task] = mgr.rpc(rpc_querry)
-                sleep(1)
-            return response
+        rpc_querry = self.get_arp_rpc(interface)
+        response['arp'] = self.rpc(rpc_querry, username, password, port)
+        return response
+
+    def get_arp_rpc(self, interface=None):
+        rpc_querry = etree.Element(self.GET_ARP_RPC)
+        etree.SubElement(rpc_querry, 'no-resolve')
+        if interface:
+            etree.SubElement(rpc_querry, 'interface').text = interface
+        return rpc_querry
+
+    @staticmethod
+    def get_arp_filter(irb):
+        # the router matches exact interface names only, patterns
+        # are still applied by get_conditions
+        if not irb or irb.endswith('*'):
+            return None
+        return irb
+
+    def get_session(self, username, password, port=22):
+        # an open session only serves the login it was opened with
+        login = (username, password, str(port))
+        if (self.session is not None and self.session.connected and
+                self.session_login == login):
+            return self.session
+        self.close_session()
+        self.session = self.connect(username, password, port)
+        self.session_login = login
+        return self.session
+
+    def connect(self, username, password, port=22):
+        for attempt in range(1, self.CONNECT_ATTEMPTS + 1):
+            print('{}: Connecting to router {}'.format(self.ttime(),
+                                                       self.router))
+            try:
+                with self.metrics.phase('netconf_connect'):
+                    session = manager.connect(
+                        host=self.router,
+                        port=port,
+                        username=username,
+                        password=password,
+                        hostkey_verify=False,
+                        device_params={'name': 'junos'})
+            except transport_errors.AuthenticationError as error:
+                logger.error(error, exc_info=True)
+                raise MwcheckerError(error)
+            except (transport_errors.TransportError, OSError) as error:
+                logger.warning('%s: connect attempt %s failed: %s',
+                               self.router, attempt, error)
+                self.metrics.count('netconf_connect_retries')
+                if attempt == self.CONNECT_ATTEMPTS:
+                    raise MwcheckerError(error)
+                sleep(self.RETRY_DELAY * attempt)
+            else:
+                session.timeout = self.RPC_TIMEOUT
+                return session
+
+    def rpc(self, rpc_querry, username, password, port=22):
+        for attempt in range(1, self.RPC_ATTEMPTS + 1):
+            session = self.get_session(username, password, port)
+            try:
+                with self.metrics.phase('netconf_rpc'):
+                    return session.rpc(rpc_querry)
+            except (transport_errors.TransportError,
+                    rpc_errors.TimeoutExpiredError, OSError) as error:
+                logger.warning('%s: rpc attempt %s failed: %s',
+                               self.router, attempt, error)
+                self.metrics.count('netconf_rpc_retries')
+                self.close_session()
+                if attempt == self.RPC_ATTEMPTS:
+                    raise MwcheckerError(error)
+
+    def close_session(self):
+        if self.session is None:
+            return
+        try:
+            self.session.close_session()
+        except Exception as error:
+            logger.warning('%s: %s', self.router, error)
+        self.session = None
+        self.session_login = None
+
+    def close(self):
+        self.close_session()
+        super().close()
 
     def parse_arp(self, input_xml):
         all_arp_entries = input_xml.xpath(self.ARP_XPATH)
         parsed_entries = []
         for arp_entry in all_arp_entries:
-            entry = {}
-            entry['arp_ip'] = self.get_xpath(arp_entry, 'ip-address')
-            entry['arp_mac'] = self.get_xpath(arp_entry, 'mac-address')
+            arp_ip = self.get_xpath(arp_entry, 'ip-address')
+            arp_mac = self.get_xpath(arp_entry, 'mac-address')
             interface = self.get_xpath(arp_entry, 'interface-name')
             parsed_interface = self.ARP_IRB_IFL_PATTERN.search(interface)
             if parsed_interface:
-                entry['arp_ifl'] = parsed_interface.group('ifl')
-                entry['arp_irb'] = parsed_interface.group('irb')
+                arp_ifl = parsed_interface.group('ifl')
+                arp_irb = parsed_interface.group('irb')
             else:
-                entry['arp_ifl'] = interface
-                entry['arp_irb'] = 'n_a'
-            parsed_entries.append(entry)
+                arp_ifl = interface
+                arp_irb = 'n_a'
+            parsed_entries.append(ArpEntry(arp_ip, arp_mac, arp_ifl, arp_irb))
         return parsed_entries
 
-    def get_conditions_sql(self, **conditions):
+    def iter_arp(self, input_xml, span=None):
+        if isinstance(input_xml, str):
+            input_xml = input_xml.encode()
+        if isinstance(input_xml, bytes):
+            input_xml = io.BytesIO(input_xml)
+        if hasattr(input_xml, 'read'):
+            arp_entries = (element for _, element in
+                           etree.iterparse(input_xml, tag=self.ARP_ENTRY_TAG))
+        else:
+            if not etree.iselement(input_xml):
+                input_xml = input_xml.xpath('/*')[0]
+            arp_entries = input_xml.iter(self.ARP_ENTRY_TAG)
+        # the entries are parsed while the caller stores them, the time
+        # spent here is reported as its own arp_parse phase and taken out
+        # of the span of the caller
+        if span is None:
+            span = Span()
+        arp_entries = iter(arp_entries)
+        interfaces = {}
+        parsed = 0
+        parse_time = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                arp_entry = next(arp_entries, None)
+                if arp_entry is not None:
+                    arp_entry = self.parse_arp_entry(arp_entry, interfaces)
+                elapsed = time.perf_counter() - started
+                parse_time += elapsed
+                span.excluded += elapsed
+                if arp_entry is None:
+                    break
+                parsed += 1
+                yield arp_entry
+        finally:
+            self.metrics.count('arp_entries_parsed', parsed)
+            self.metrics.record('arp_parse', parse_time)
+
+    def parse_arp_entry(self, arp_entry, interfaces):
+        # one pass over the children is cheaper than a lookup per field
+        fields = {}
+        for child in arp_entry:
+            if isinstance(child.tag, str):
+                fields.setdefault(child.tag.rpartition('}')[2],
+                                  child.text)
+        # a few interfaces serve the whole table, so they are split once
+        # and every entry shares the same ifl and irb strings
+        interface = fields.get('interface-name')
+        split_interface = interfaces.get(interface)
+        if split_interface is None:
+            split_interface = self.split_interface(self.clean_text(interface))
+            interfaces[interface] = split_interface
+        # drop parsed entries so the reply shrinks while it is walked
+        arp_entry.clear()
+        while arp_entry.getprevious() is not None:
+            del arp_entry.getparent()[0]
+        return ArpEntry(self.clean_text(fields.get('ip-address')),
+                        sys.intern(self.clean_text(fields.get('mac-address'))),
+                        *split_interface)
+
+    def split_interface(self, interface):
+        parsed_interface = self.ARP_IRB_IFL_PATTERN.search(interface)
+        if parsed_interface:
+            return (sys.intern(parsed_interface.group('ifl')),
+                    sys.intern(parsed_interface.group('irb')))
+        return sys.intern(interface), 'n_a'
+
+    def get_conditions(self, **conditions):
+        # patterns are bound as GLOB parameters, their fixed prefix lets
+        # SQLite answer them from the hosts indexes
         condition_list = []
+        parameters = []
         for field, pattern in conditions.items():
             if not field or not pattern:
                 continue
             if pattern.endswith('*'):
-                operator = ' LIKE '
-                pattern = '"%{}%"'.format(pattern.rstrip('*'))
+                operator = 'GLOB'
+                pattern = pattern.translate(self.GLOB_TRANSLATION)
             else:
                 operator = '='
-                pattern = '"{}"'.format(pattern)
-            expression = self.CONDITION_EXPRESSION.format(field=field,
-                                                          operator=operator,
-                                                          pattern=pattern)
-            condition_list.append(expression)
-        return ' AND '.join(condition_list)
-
-    def get_ip_address(self, hosts_sql_querry):
-        collumn = self.execute(sql_request=hosts_sql_querry)
-        if not collumn:
-            return ()
-        return [row['arp_ip'] for row in collumn]
+            condition_list.append(self.CONDITION_EXPRESSION.format(
+                field=field, operator=operator))
+            parameters.append(pattern)
+        return ' AND '.join(condition_list), tuple(parameters)
+
+    @staticmethod
+    def get_arp_matcher(irb='', ifl=''):
+        # the conditions of get_conditions applied to parsed ARP entries
+        checks = []
+        for field, pattern in (('arp_irb', irb), ('arp_ifl', ifl)):
+            if not pattern:
+                continue
+            if pattern.endswith('*'):
+                match = re.compile(''.join(
+                    {'_': '.', '*': '.*'}.get(character, re.escape(character))
+                    for character in pattern), re.DOTALL).fullmatch
+            else:
+                match = pattern.__eq__
+            checks.append((field, match))
+        if not checks:
+            return None
+        return lambda entry: all(match(getattr(entry, field))
+                                 for field, match in checks)
+
+    @staticmethod
+    def read_precheck_tables(path):
+        # one precheck ID per line, followed by its irb= and ifl= filters
+        tables = {}
+        with open(path) as tables_file:
+            for number, line in enumerate(tables_file, 1):
+                fields = line.split('#', 1)[0].split()
+                if not fields:
+                    continue
+                try:
+                    table = 'precheck_{}'.format(int(fields[0]))
+                    arp_filter = ArpFilter(**dict(field.split('=', 1)
+                                                  for field in fields[1:]))
+                except (ValueError, TypeError):
+                    raise MwcheckerError(
+                        '{}:{}: expected an ID followed by irb= or ifl= '
+                        'filters'.format(path, number))
+                if table in tables:
+                    raise MwcheckerError('{}:{}: {} is listed twice'.format(
+                        path, number, table))
+                tables[table] = arp_filter
+        if not tables:
+            raise MwcheckerError('{} lists no precheck table'.format(path))
+        return tables
+
+    def get_ip_address(self, hosts_sql_querry, parameters=()):
+        return HostList(row[0] for row in self.iterate(hosts_sql_querry,
+                                                       parameters))
 
     def get_report(self, precheck='', postcheck=''):
-        unreachable_sql = self.LOSTED_HOST_SQL.format(precheck=precheck,
-                                                      postcheck=postcheck)
-        sql_list = [unreachable_sql]
-        tables = {'precheck': precheck,
-                  'postcheck': postcheck}
-
-        for stage, table in tables.items():
-            for sql_template in self.REPORT_PARAMETERS:
-                sql_query = sql_template.format(parameter=stage,
-                                                table=table)
-                sql_list.append(sql_query)
-
-        result_list = self.get_many(sql_list)
-        unreachable_hosts = result_list.pop(0)
-        for result in result_list:
-            for row in result:
-                for field, value in dict(row).items():
+        with self.metrics.phase('report'):
+            # tables of older versions which were not migrated yet
+            if self.get_object_type(precheck) == 'table':
+                self.create_indexes(precheck, self.PRECHECK_INDEXES)
+            if self.get_object_type(postcheck) == 'table':
+                self.create_indexes(postcheck, self.POSTCHECK_INDEXES)
+            tables = {'precheck': precheck,
+                      'postcheck': postcheck}
+            for stage, table in tables.items():
+                sql_query = self.STAGE_STATS_SQL.format(stage=stage,
+                                                        table=table)
+                result = self.execute(sql_query)
+                if not result:
+                    raise MwcheckerError(
+                        'unable to read table {}'.format(table))
+                for field, value in dict(result[0]).items():
                     print(field, value)
-        out_file = '{db}_{pre}_{post}'.format(db=self.dbname,
-                                              pre=precheck,
-                                              post=postcheck)
-        if unreachable_hosts:
-            self.write_report(out_file, unreachable_hosts)
-        else:
-            print('no unreacheable hosts')
+            unreachable_sql = self.LOSTED_HOST_SQL.format(precheck=precheck,
+                                                          postcheck=postcheck)
+            out_file = '{db}_{pre}_{post}'.format(db=self.dbname,
+                                                  pre=precheck,
+                                                  post=postcheck)
+            lost = self.write_report(out_file,
+                                     self.iterate(unreachable_sql))
+            if not lost:
+                print('no unreacheable hosts')
+            return lost
 
-    def write_report(self, output, report):
+    def get_comparison_report(self, snapshots, rtt_threshold=RTT_THRESHOLD):
+        with self.metrics.phase('report'):
+            legacy_tables = [table for table in self.get_legacy_tables()
+                             if table in snapshots]
+            if legacy_tables:
+                raise MwcheckerError(
+                    '{} keeps {} in the per-table format of older versions, '
+                    'run migrate first'.format(self.dbname,
+                                               ', '.join(legacy_tables)))
+            snapshot_ids = [self.get_snapshot_id(name) for name in snapshots]
+            columns = [self.COMPARE_COLUMN_SQL.format(snapshot=snapshot,
+                                                      field=field)
+                       for snapshot in snapshot_ids
+                       for field in self.COMPARE_FIELDS]
+            compare_sql = self.COMPARE_SQL.format(
+                columns=', '.join(columns),
+                snapshots=', '.join(str(snapshot)
+                                    for snapshot in snapshot_ids))
+            header = ['ip']
+            for name in snapshots:
+                header += ['{}_{}'.format(name, field)
+                           for field in self.COMPARE_FIELDS]
+            header += ['lost_at', 'slower_at', 'rtt_increase']
+            stats = {'hosts': 0}
+            for name in snapshots:
+                stats[name + '_reachable'] = 0
+                stats[name + '_unreachable'] = 0
+            stats.update(lost_hosts=0, slower_hosts=0)
+            out_file = '{db}_compare_{names}'.format(db=self.dbname,
+                                                     names='_'.join(snapshots))
+            self.write_report(out_file,
+                              self.compare_hosts(self.iterate(compare_sql),
+                                                 snapshots, rtt_threshold,
+                                                 stats),
+                              header=header)
+            for field, value in stats.items():
+                print(field, value)
+            return stats['lost_hosts']
+
+    def compare_hosts(self, rows, snapshots, rtt_threshold, stats):
+        # a host is lost at the first snapshot where it fails after it
+        # answered before, and slower at the first one where its rtt
+        # exceeds the earliest measured rtt by more than the threshold
+        fields = len(self.COMPARE_FIELDS)
+        for row in rows:
+            row = list(row)
+            lost_at = slower_at = baseline = increase = None
+            reachable = False
+            for index, name in enumerate(snapshots):
+                ping, rtt, _ = row[1 + index * fields:1 + (index + 1) * fields]
+                if ping == 'OK':
+                    reachable = True
+                    stats[name + '_reachable'] += 1
+                elif ping == 'FAILED':
+                    stats[name + '_unreachable'] += 1
+                    if reachable and lost_at is None:
+                        lost_at = name
+                if rtt is None:
+                    continue
+                if baseline is None:
+                    baseline = rtt
+                    continue
+                if increase is None or rtt - baseline > increase:
+                    increase = rtt - baseline
+                if rtt - baseline > rtt_threshold and slower_at is None:
+                    slower_at = name
+            stats['hosts'] += 1
+            stats['lost_hosts'] += lost_at is not None
+            stats['slower_hosts'] += slower_at is not None
+            yield row + [lost_at, slower_at,
+                         None if increase is None else round(increase, 3)]
+
+    def get_monitor_report(self, table):
+        with self.metrics.phase('report'):
+            sweeps_table = self.MONITOR_SWEEPS_TABLE.format(table)
+            result = self.execute(self.MONITOR_STATS_SQL.format(
+                table=table, sweeps=sweeps_table))
+            if not result:
+                raise MwcheckerError('unable to read table {}'.format(table))
+            for field, value in dict(result[0]).items():
+                print(field, value)
+            outages_sql = self.MONITOR_OUTAGES_SQL.format(table=table,
+                                                          sweeps=sweeps_table)
+            out_file = '{db}_{table}_outages'.format(db=self.dbname,
+                                                     table=table)
+            outages = self.write_report(out_file, self.iterate(outages_sql))
+            if not outages:
+                print('no outages')
+            return outages
+
+    def write_report(self, output, report, header=None):
+        report = iter(report)
+        first_row = next(report, None)
+        if first_row is None:
+            return 0
         output += '.csv'
-        fieldnames = report[0].keys()
         with open(output, 'w', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
+            writer = csv.writer(csvfile)
+            writer.writerow(header or first_row.keys())
+            writer.writerow(first_row)
+            written = 1
             for row in report:
-                writer.writerow(dict(row))
+                writer.writerow(row)
+                written += 1
+        return written
 
     @staticmethod
     def ttime():
         return dt.datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
 
+    @staticmethod
+    def clean_text(text, else_return='n_a'):
+        if not text:
+            return else_return
+        return text.strip()
+
     @staticmethod
     def get_xpath(xml, path, else_return='n_a', ignore_namespaces=False):
         if ignore_namespaces:
@@ -349,40 +2283,504 @@ class Mwchecker(DBHandler):
         return raw_result[0].text.strip()
 
 
-def precheck_arp(mwc_object, args):
+class Fleet:
+    WORKERS_NUMBER = 8
+    SUMMARY_FIELDS = ('probed', 'reachable', 'unreachable', 'lost', 'status')
+    SUMMARY_ROW = '{:<24} {:>8} {:>10} {:>12} {:>6}  {}'
+
+    def __init__(self, inventory, workers=WORKERS_NUMBER, **options):
+        self.workers = workers
+        self.checkers = []
+        self.ports = {}
+        for router, port in self.read_inventory(inventory):
+            self.checkers.append(Mwchecker(router=router, **options))
+            self.ports[router] = port
+        self.results = {mwc.router: {} for mwc in self.checkers}
+
+    @staticmethod
+    def read_inventory(inventory):
+        with open(inventory) as inventory_file:
+            for line in inventory_file:
+                fields = line.split('#', 1)[0].split()
+                if not fields:
+                    continue
+                port = int(fields[1]) if len(fields) > 1 else None
+                yield fields[0], port
+
+    def active(self):
+        return [mwc for mwc in self.checkers
+                if 'error' not in self.results[mwc.router]]
+
+    def fail(self, mwc, error):
+        logger.error('%s: %s', mwc.router, error)
+        print('{}: {} failed: {}'.format(mwc.ttime(), mwc.router, error))
+        self.results[mwc.router]['error'] = str(error)
+
+    def run_parallel(self, task):
+        with futures.ThreadPoolExecutor(self.workers) as executor:
+            submitted = {executor.submit(task, mwc): mwc
+                         for mwc in self.active()}
+            for future in futures.as_completed(submitted):
+                try:
+                    future.result()
+                except (MwcheckerError, Exception) as error:
+                    self.fail(submitted[future], error)
+
+    def init_precheck_database(self, table_name):
+        for mwc in self.active():
+            try:
+                mwc.init_precheck_database(table_name)
+            except MwcheckerError as error:
+                self.fail(mwc, error)
+
+    def init_postcheck_database(self, table_name):
+        for mwc in self.active():
+            try:
+                mwc.init_postcheck_database(table_name)
+            except MwcheckerError as error:
+                self.fail(mwc, error)
+
+    def set_login(self, username, password, port=22):
+        for mwc in self.checkers:
+            mwc.set_login(username, password, self.ports[mwc.router] or port)
+
+    def fetch_precheck_arp(self, username, password,
+                           destination_table, port=22, irb=None):
+        def fetch(mwc):
+            mwc.fetch_precheck_arp(username=username,
+                                   password=password,
+                                   destination_table=destination_table,
+                                   port=self.ports[mwc.router] or port,
+                                   irb=irb)
+        self.run_parallel(fetch)
+
+    def fetch_postcheck_arp(self, username, password,
+                            destination_table, port=22):
+        def fetch(mwc):
+            mwc.fetch_postcheck_arp(username=username,
+                                    password=password,
+                                    destination_table=destination_table,
+                                    port=self.ports[mwc.router] or port)
+        self.run_parallel(fetch)
+
+    def fetch_precheck_pings(self, table, irb=None, ifl=None, resume=False):
+        self.fetch_pings(self.get_jobs(
+            lambda mwc: mwc.get_precheck_pings_sql(table, irb, ifl, resume)))
+
+    def fetch_postcheck_pings(self, source_table, destination_table,
+                              resume=False):
+        self.fetch_pings(self.get_jobs(
+            lambda mwc: mwc.get_postcheck_pings_sql(source_table,
+                                                    destination_table,
+                                                    resume)))
+
+    def get_jobs(self, get_job):
+        # a router whose snapshots can't be read is reported and skipped
+        jobs = {}
+        for mwc in self.active():
+            try:
+                jobs[mwc] = get_job(mwc)
+            except MwcheckerError as error:
+                self.fail(mwc, error)
+        return jobs
+
+    def fetch_pings(self, jobs):
+        if any(mwc.ping_backend == 'router' for mwc in jobs):
+            return self.fetch_router_pings(jobs)
+        # every distinct address is probed once in a single sweep, so the
+        # concurrency cap of the probe engine applies to the whole fleet
+        targets = {}
+        writers = {}
+        if jobs:
+            # the routers share the sweep and so the backend it falls
+            # back to, their writers cache results under it
+            backend = next(iter(jobs)).resolve_ping_backend()
+            for mwc in jobs:
+                mwc.ping_backend = backend
+        for mwc, (source_sql, dest_sql, parameters) in jobs.items():
+            try:
+                hosts_list = mwc.get_ip_address(source_sql, parameters)
+                writer = mwc.get_ping_writer(dest_sql,
+                                             total=len(hosts_list),
+                                             label=mwc.router)
+                cached, hosts_list = mwc.get_cached_pings(hosts_list)
+                for ping in cached:
+                    writer.add(ping, cache=False)
+            except MwcheckerError as error:
+                self.fail(mwc, error)
+                continue
+            writers[mwc] = writer
+            mwc.count_cache(len(cached), len(hosts_list))
+            for host in hosts_list:
+                targets.setdefault(host, []).append(mwc)
+        if not targets:
+            # every host of every router came from the probe cache
+            for mwc in list(writers):
+                self.write_ping(mwc, writers)
+        else:
+            print('{}: Starting to ping {} hosts connected to {} '
+                  'routers'.format(Mwchecker.ttime(), len(targets),
+                                   len(writers)))
+            scheduler = next(iter(writers))
+            with scheduler.metrics.phase('ping_sweep'):
+                try:
+                    for ping in scheduler.get_pings_runner(list(targets)):
+                        for mwc in targets[ping.arp_ip]:
+                            self.write_ping(mwc, writers, ping)
+                except KeyboardInterrupt:
+                    for mwc in list(writers):
+                        self.write_ping(mwc, writers)
+                    Mwchecker.print_interrupted(sum(
+                        writer.written for writer in writers.values()))
+                    raise
+                for mwc in list(writers):
+                    self.write_ping(mwc, writers)
+        for mwc, writer in writers.items():
+            mwc.count_pings(writer)
+            self.results[mwc.router].update(probed=writer.written,
+                                            reachable=writer.reachable,
+                                            unreachable=writer.unreachable)
+
+    def fetch_router_pings(self, jobs):
+        # every router pings its own hosts, each within its session cap
+        def fetch(mwc):
+            writer = mwc.fetch_pings(*jobs[mwc])
+            self.results[mwc.router].update(probed=writer.written,
+                                            reachable=writer.reachable,
+                                            unreachable=writer.unreachable)
+        self.run_parallel(fetch)
+
+    def write_ping(self, mwc, writers, ping=None):
+        if 'error' in self.results[mwc.router]:
+            return
+        try:
+            if ping is None:
+                writers[mwc].close()
+            else:
+                writers[mwc].add(ping)
+        except MwcheckerError as error:
+            self.fail(mwc, error)
+
+    def get_report(self, precheck='', postcheck=''):
+        for mwc in self.active():
+            print('{}: Report for router {}'.format(mwc.ttime(), mwc.router))
+            try:
+                lost = mwc.get_report(precheck=precheck, postcheck=postcheck)
+            except (MwcheckerError, Exception) as error:
+                self.fail(mwc, error)
+            else:
+                self.results[mwc.router]['lost'] = lost
+
+    def get_comparison_report(self, snapshots,
+                              rtt_threshold=Mwchecker.RTT_THRESHOLD):
+        for mwc in self.active():
+            print('{}: Report for router {}'.format(mwc.ttime(), mwc.router))
+            try:
+                lost = mwc.get_comparison_report(snapshots,
+                                                 rtt_threshold=rtt_threshold)
+            except (MwcheckerError, Exception) as error:
+                self.fail(mwc, error)
+            else:
+                self.results[mwc.router]['lost'] = lost
+
+    def migrate_snapshots(self):
+        for mwc in self.active():
+            try:
+                mwc.migrate_snapshots()
+            except (MwcheckerError, Exception) as error:
+                self.fail(mwc, error)
+
+    def print_summary(self):
+        print(self.SUMMARY_ROW.format('router', *self.SUMMARY_FIELDS))
+        totals = dict.fromkeys(self.SUMMARY_FIELDS[:-1], 0)
+        for router, result in self.results.items():
+            row = []
+            for field in self.SUMMARY_FIELDS[:-1]:
+                row.append(result.get(field, '-'))
+                totals[field] += result.get(field, 0)
+            status = 'FAILED {}'.format(result['error']) if (
+                'error' in result) else 'OK'
+            print(self.SUMMARY_ROW.format(router, *row, status))
+        failed = len(self.checkers) - len(self.active())
+        print(self.SUMMARY_ROW.format(
+            'total', *totals.values(),
+            '{} routers, {} failed'.format(len(self.checkers), failed)))
+
+    def close(self):
+        for mwc in self.checkers:
+            mwc.close()
+
+
+class AgentOutput:
+    # print() of a job reaches the client which sent it, anything else
+    # the stdout the agent was started with
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def write(self, text):
+        send = getattr(self.local, 'send', None)
+        if send is None:
+            return self.stdout.write(text)
+        send({'output': text})
+        return len(text)
+
+    def flush(self):
+        if getattr(self.local, 'send', None) is None:
+            self.stdout.flush()
+
+    def __getattr__(self, attribute):
+        return getattr(self.stdout, attribute)
+
+
+class Agent:
+    SOCKET = 'mw_checker.sock'
+    # monitor run holds its router for hours and stays a foreground task
+    TASKS = ('precheck_arp', 'precheck_ping', 'precheck_all',
+             'postcheck_arp', 'postcheck_ping', 'postcheck_all',
+             'report_get', 'monitor_report', 'migrate')
+    LOGIN_TASKS = ('precheck_arp', 'precheck_all',
+                   'postcheck_arp', 'postcheck_all')
+
+    def __init__(self, path=SOCKET, **db_options):
+        self.path = path
+        self.db_options = db_options
+        self.checkers = {}
+        self.locks = {}
+        self.passwords = {}
+        self.lock = threading.Lock()
+        self.output = AgentOutput(sys.stdout)
+
+    def serve(self):
+        listener = self.listen()
+        print('{}: Agent listening on {}'.format(Mwchecker.ttime(),
+                                                 self.path))
+        stdout, sys.stdout = sys.stdout, self.output
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+        try:
+            while True:
+                connection, _ = listener.accept()
+                threading.Thread(target=self.handle,
+                                 args=(connection,),
+                                 daemon=True).start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sys.stdout = stdout
+            listener.close()
+            os.unlink(self.path)
+            self.close()
+            print('{}: Agent stopped'.format(Mwchecker.ttime()))
+
+    def listen(self):
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except OSError:
+                # left behind by an agent which didn't stop cleanly
+                os.unlink(self.path)
+            else:
+                raise MwcheckerError(
+                    'an agent already listens on {}'.format(self.path))
+            finally:
+                probe.close()
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # only the user running the agent may hand it jobs
+        umask = os.umask(0o177)
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        listener.listen()
+        return listener
+
+    def handle(self, connection):
+        with connection, connection.makefile('rb') as stream:
+            def send(message):
+                try:
+                    connection.sendall(json.dumps(message).encode() + b'\n')
+                except OSError:
+                    # the client went away, its job still runs to the end
+                    pass
+
+            try:
+                request = json.loads(stream.readline() or 'null')
+                self.run_job(request, stream, send)
+            except (MwcheckerError, Exception) as error:
+                logger.error(error, exc_info=True)
+                send({'exit': 1, 'error': str(error)})
+            else:
+                send({'exit': 0})
+
+    def run_job(self, request, stream, send):
+        if not request or request.get('task') not in self.TASKS:
+            raise MwcheckerError('the agent does not run {}'.format(
+                request and request.get('task')))
+        task = request['task']
+        args = argparse.Namespace(**request['args'])
+        if getattr(args, 'tables', None):
+            args.tables = self.get_path(request, args.tables)
+        login = (args.router, getattr(args, 'user', None),
+                 str(getattr(args, 'port', 22)))
+        args.password = None
+        if task in self.LOGIN_TASKS or (
+                getattr(args, 'backend', None) == 'router' and
+                task in ('precheck_ping', 'postcheck_ping')):
+            args.password = self.passwords.get(login)
+            if args.password is None:
+                send({'password': True})
+                reply = json.loads(stream.readline() or 'null')
+                if not reply or not reply.get('password'):
+                    raise MwcheckerError('no password from the client')
+                args.password = reply['password']
+        mwc = self.get_checker(args.router)
+        with self.get_lock(mwc.dbname):
+            started = time.monotonic()
+            mwc.set_ping_options(**get_ping_options(args))
+            mwc.login = None
+            mwc.metrics = Metrics(enabled=bool(args.metrics_json or
+                                               args.metrics_prom),
+                                  profile_dir=self.get_path(request,
+                                                            args.profile),
+                                  labels={'router': args.router})
+            self.output.local.send = send
+            try:
+                globals()[task](mwc, args)
+            except BaseException:
+                # a changed password must be asked for again
+                self.passwords.pop(login, None)
+                raise
+            finally:
+                self.output.local.send = None
+                if args.metrics_json:
+                    mwc.metrics.export_json(
+                        self.get_path(request, args.metrics_json))
+                if args.metrics_prom:
+                    mwc.metrics.export_prometheus(
+                        self.get_path(request, args.metrics_prom))
+            # only a password the router accepted for this login is kept
+            if args.password and mwc.session_login == (
+                    login[1], args.password, login[2]):
+                self.passwords[login] = args.password
+        logger.info('%s: %s done in %.1fs', args.router, task,
+                    time.monotonic() - started)
+
+    @staticmethod
+    def get_path(request, path):
+        # file options are given relative to the directory of the client
+        if path is None:
+            return None
+        return os.path.join(request.get('cwd', ''), path)
+
+    def get_checker(self, router):
+        # every router keeps its NETCONF session and database handle
+        # open between jobs
+        with self.lock:
+            if router not in self.checkers:
+                self.checkers[router] = Mwchecker(router=router,
+                                                  **self.db_options)
+            return self.checkers[router]
+
+    def get_lock(self, dbname):
+        with self.lock:
+            return self.locks.setdefault(dbname, threading.Lock())
+
+    def close(self):
+        for mwc in self.checkers.values():
+            mwc.close()
+
+
+def run_agent_job(args):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(args.agent_socket)
+    except OSError as error:
+        client.close()
+        raise MwcheckerError('no agent listens on {}: {}'.format(
+            args.agent_socket, error))
+    request = {'task': args.function.__name__,
+               'cwd': os.getcwd(),
+               'args': {key: value for key, value in vars(args).items()
+                        if key != 'function'}}
+    with client, client.makefile('rb') as stream:
+        def send(message):
+            client.sendall(json.dumps(message).encode() + b'\n')
+
+        send(request)
+        for line in stream:
+            message = json.loads(line)
+            if 'output' in message:
+                sys.stdout.write(message['output'])
+            elif 'password' in message:
+                send({'password': getpass()})
+            elif 'exit' in message:
+                if message.get('error'):
+                    print('{}: {} failed: {}'.format(
+                        Mwchecker.ttime(), args.router, message['error']),
+                        file=sys.stderr)
+                return message['exit']
+    raise MwcheckerError('the agent closed the connection')
+
+
+def precheck_arp(mwc_object, args, password=None):
     table = 'precheck_{}'.format(str(args.dest))
-    password = getpass()
+    if password is None:
+        password = ask_password(args)
+    if args.tables:
+        tables = mwc_object.read_precheck_tables(args.tables)
+        for table in tables:
+            mwc_object.init_precheck_database(table)
+        mwc_object.fetch_precheck_arp_tables(username=args.user,
+                                             password=password,
+                                             tables=tables,
+                                             port=args.port)
+        return
     mwc_object.init_precheck_database(table)
     mwc_object.fetch_precheck_arp(username=args.user,
                                   password=password,
                                   destination_table=table,
-                                  port=args.port)
+                                  port=args.port,
+                                  irb=getattr(args, 'irb', None))
 
 
-def precheck_ping(mwc_object, args):
+def precheck_ping(mwc_object, args, password=None):
     table = 'precheck_{}'.format(str(args.dest))
+    set_router_login(mwc_object, args, password)
+    if args.tables:
+        tables = mwc_object.read_precheck_tables(args.tables)
+        for table in tables:
+            mwc_object.init_precheck_database(table)
+        mwc_object.fetch_precheck_pings_tables(
+            tables=tables, resume=getattr(args, 'resume', False))
+        return
+    mwc_object.init_precheck_database(table)
     mwc_object.fetch_precheck_pings(table=table,
                                     irb=args.irb,
-                                    ifl=args.ifl)
+                                    ifl=args.ifl,
+                                    resume=getattr(args, 'resume', False))
 
 
 def precheck_all(mwc_object, args):
-    precheck_arp(mwc_object, args)
-    precheck_ping(mwc_object, args)
+    password = ask_password(args)
+    precheck_arp(mwc_object, args, password=password)
+    precheck_ping(mwc_object, args, password=password)
 
 
-def postcheck_ping(mwc_object, args):
+def postcheck_ping(mwc_object, args, password=None):
     source_table = 'precheck_{}'.format(str(args.source))
     destination_table = 'postcheck_{}'.format(str(args.dest))
+    set_router_login(mwc_object, args, password)
     mwc_object.init_postcheck_database(destination_table)
     mwc_object.fetch_postcheck_pings(source_table=source_table,
-                                     destination_table=destination_table)
+                                     destination_table=destination_table,
+                                     resume=getattr(args, 'resume', False))
 
 
 def postcheck_arp(mwc_object, args, password=None):
     table = 'postcheck_{}'.format(str(args.dest))
     if password is None:
-        password = getpass()
+        password = ask_password(args)
     mwc_object.init_postcheck_database(table)
     mwc_object.fetch_postcheck_arp(username=args.user,
                                    password=password,
@@ -391,23 +2789,230 @@ def postcheck_arp(mwc_object, args, password=None):
 
 
 def postcheck_all(mwc_object, args):
-    password = getpass()
-    postcheck_ping(mwc_object, args)
+    password = ask_password(args)
+    postcheck_ping(mwc_object, args, password=password)
     postcheck_arp(mwc_object, args, password=password)
 
 
 def report_get(mwc_object, args):
+    if args.snapshots:
+        mwc_object.get_comparison_report(snapshots=args.snapshots,
+                                         rtt_threshold=args.rtt_threshold)
+        return
     precheck_table = 'precheck_{}'.format(str(args.precheck))
     postcheck_table = 'postcheck_{}'.format(str(args.postcheck))
     mwc_object.get_report(precheck=precheck_table,
                           postcheck=postcheck_table)
 
 
+def monitor_run(mwc_object, args):
+    source_table = 'precheck_{}'.format(str(args.source))
+    table = 'monitor_{}'.format(str(args.dest))
+    set_router_login(mwc_object, args)
+    mwc_object.init_monitor_database(table)
+    mwc_object.monitor(source_table=source_table,
+                       table=table,
+                       interval=args.interval,
+                       sweeps=args.sweeps,
+                       duration=args.duration)
+    mwc_object.get_monitor_report(table)
+
+
+def monitor_report(mwc_object, args):
+    table = 'monitor_{}'.format(str(args.dest))
+    mwc_object.get_monitor_report(table)
+
+
+def migrate(mwc_object, args):
+    mwc_object.migrate_snapshots()
+
+
+def ask_password(args):
+    # jobs run by the agent carry the password of the client
+    return getattr(args, 'password', None) or getpass()
+
+
+def set_router_login(mwc_object, args, password=None):
+    # only the router backend logs in to ping
+    if getattr(args, 'backend', None) != 'router':
+        return
+    if password is None:
+        password = ask_password(args)
+    mwc_object.set_login(username=args.user,
+                         password=password,
+                         port=args.port)
+
+
+def add_login_arguments(subparser):
+    subparser.add_argument('--user',
+                           type=str,
+                           help='Set user to ping from the box with '
+                                '--backend router')
+    subparser.add_argument('--port',
+                           default=22,
+                           help='specify port to connect device 22 is default')
+
+
+def add_tables_argument(subparser):
+    subparser.add_argument('--tables',
+                           type=str,
+                           help=('file with one precheck ID per line, '
+                                 'optionally followed by irb= and ifl= '
+                                 'filters, fills all of them from a single '
+                                 'ARP fetch and ping sweep instead of --dest'))
+
+
+def add_ping_arguments(subparser):
+    subparser.add_argument('--backend',
+                           choices=Mwchecker.PING_BACKENDS,
+                           default=Mwchecker.PING_BACKEND,
+                           help=('icmp probes hosts in-process, subprocess '
+                                 'runs the system ping per host, icmp falls '
+                                 'back to subprocess when ICMP sockets '
+                                 'are not permitted, router pings from the '
+                                 'router through NETCONF'))
+    subparser.add_argument('--count',
+                           type=int,
+                           default=Mwchecker.PING_COUNT,
+                           help='echo requests sent to each host')
+    subparser.add_argument('--timeout',
+                           type=float,
+                           default=Mwchecker.PING_TIMEOUT,
+                           help='seconds to wait for a reply from each host')
+    subparser.add_argument('--concurrency',
+                           type=int,
+                           default=Mwchecker.PING_CONCURRENCY,
+                           help='hosts probed in parallel by icmp backend')
+    subparser.add_argument('--rate',
+                           type=float,
+                           default=Mwchecker.PING_RATE,
+                           help=('echo requests per second sent by icmp '
+                                 'backend, 0 is unlimited'))
+    subparser.add_argument('--adaptive',
+                           action='store_true',
+                           help=('probe every host once with --sweep-timeout '
+                                 'first and confirm only unanswered hosts '
+                                 'with --count probes'))
+    subparser.add_argument('--sweep-timeout',
+                           type=float,
+                           default=Mwchecker.SWEEP_TIMEOUT,
+                           help='seconds to wait in the adaptive first pass')
+    subparser.add_argument('--confirm-rounds',
+                           type=int,
+                           default=Mwchecker.CONFIRM_ROUNDS,
+                           help=('adaptive confirmation passes, the timeout '
+                                 'doubles on every pass'))
+    subparser.add_argument('--router-sessions',
+                           type=int,
+                           default=Mwchecker.ROUTER_SESSIONS,
+                           help=('NETCONF sessions pinging in parallel with '
+                                 '--backend router, caps the load on the '
+                                 'routing engine'))
+
+
+def add_cache_arguments(subparser):
+    subparser.add_argument('--cache-ttl',
+                           type=int,
+                           default=Mwchecker.CACHE_TTL,
+                           help=('reuse results of hosts probed less than '
+                                 'this many seconds ago by any precheck or '
+                                 'postcheck of the router, 0 probes all'))
+    subparser.add_argument('--cache-retention',
+                           type=int,
+                           default=Mwchecker.CACHE_RETENTION,
+                           help='seconds a result is kept in the probe cache')
+    subparser.add_argument('--force-probe',
+                           action='store_true',
+                           help='probe every host despite --cache-ttl')
+
+
+def get_db_options(args):
+    options = {'journal_mode': 'journal_mode',
+               'synchronous': 'synchronous',
+               'cache_size': 'cache_size',
+               'mmap_size': 'mmap_size'}
+    return {option: getattr(args, argument)
+            for option, argument in options.items()
+            if hasattr(args, argument)}
+
+
+def get_ping_options(args):
+    options = {'ping_backend': 'backend',
+               'ping_count': 'count',
+               'ping_timeout': 'timeout',
+               'ping_concurrency': 'concurrency',
+               'ping_rate': 'rate',
+               'ping_adaptive': 'adaptive',
+               'sweep_timeout': 'sweep_timeout',
+               'confirm_rounds': 'confirm_rounds',
+               'router_sessions': 'router_sessions',
+               'cache_ttl': 'cache_ttl',
+               'cache_retention': 'cache_retention',
+               'force_probe': 'force_probe'}
+    return {option: getattr(args, argument)
+            for option, argument in options.items()
+            if hasattr(args, argument)}
+
+
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument(dest='router',
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    # an optional router positional would swallow the task name of
+    # --inventory runs, so it is only declared for single router runs
+    if any(argument.split('=', 1)[0] in ('--inventory', '--agent')
+           for argument in sys.argv[1:]):
+        parser.set_defaults(router=None)
+    else:
+        parser.add_argument(dest='router',
+                            type=str,
+                            help='Set router for analysis')
+    parser.add_argument('--inventory',
+                        type=str,
+                        help=('file with one router per line, optionally '
+                              'followed by its NETCONF port, runs the task '
+                              'against all of them at once'))
+    parser.add_argument('--fleet-workers',
+                        type=int,
+                        default=Fleet.WORKERS_NUMBER,
+                        help='routers queried in parallel with --inventory')
+    parser.add_argument('--agent',
+                        action='store_true',
+                        help=('keep running and serve the jobs of clients '
+                              'started with --agent-socket'))
+    parser.add_argument('--agent-socket',
                         type=str,
-                        help='Set router for analysis')
+                        help=('Unix socket of the agent, the listening path '
+                              'with --agent, otherwise the task is handed to '
+                              'the agent behind it'))
+    parser.add_argument('--journal-mode',
+                        choices=DBHandler.JOURNAL_MODES,
+                        default=DBHandler.JOURNAL_MODE,
+                        type=str.upper,
+                        help='SQLite journal mode, WAL is default')
+    parser.add_argument('--synchronous',
+                        choices=DBHandler.SYNCHRONOUS_LEVELS,
+                        default=DBHandler.SYNCHRONOUS,
+                        type=str.upper,
+                        help='SQLite synchronous level, NORMAL is default')
+    parser.add_argument('--cache-size',
+                        type=int,
+                        default=DBHandler.CACHE_SIZE,
+                        help=('SQLite page cache, pages if positive, '
+                              'KiB if negative'))
+    parser.add_argument('--mmap-size',
+                        type=int,
+                        default=DBHandler.MMAP_SIZE,
+                        help='bytes of the database file mapped in memory')
+    parser.add_argument('--metrics-json',
+                        type=str,
+                        help='write phase timings, counters and histograms '
+                             'of the run as JSON into this file')
+    parser.add_argument('--metrics-prom',
+                        type=str,
+                        help='write the same metrics as a Prometheus '
+                             'textfile, e.g. for the node exporter')
+    parser.add_argument('--profile',
+                        type=str,
+                        help='directory for cProfile dumps of every phase')
     subparser = parser.add_subparsers()
     precheck = subparser.add_parser('precheck',
                                     help='Run precheck tasks')
@@ -425,6 +3030,7 @@ if __name__ == '__main__':
     arp_precheck.add_argument('--port',
                               default=22,
                               help='specify port to connect device 22 is default')
+    add_tables_argument(arp_precheck)
     arp_precheck.set_defaults(function=precheck_arp)
     ping_precheck = precheck_subparser.add_parser('ping',
                                                   help='run pings for previously fetched arp')
@@ -436,7 +3042,8 @@ if __name__ == '__main__':
                                type=str,
                                default='',
                                help=('Set ifl interface which hosts to ping, '
-                                     'use * for patterns, '
+                                     'use * for patterns matching the start '
+                                     'of the name, '
                                      'use _ as placeholder for pattern.\n'
                                      'examples:\n'
                                      'irb.1__1* (irb.1991, irb.19911) '
@@ -445,11 +3052,20 @@ if __name__ == '__main__':
                                type=str,
                                default='',
                                help=('Set ifl interface which hosts to ping, '
-                                     'use * for patterns, '
+                                     'use * for patterns matching the start '
+                                     'of the name, '
                                      'use _ as placeholder for pattern.\n'
                                      'examples:\n'
                                      'ge-_/0/1* (1/0/1, 2/0/1)'
                                      'ge-1/1/1* (1/1/1.100, 1/1/1.101'))
+    add_login_arguments(ping_precheck)
+    add_ping_arguments(ping_precheck)
+    add_cache_arguments(ping_precheck)
+    ping_precheck.add_argument('--resume',
+                              action='store_true',
+                              help='ping only the hosts without a stored result, '
+                                   'e.g. after an interrupted run')
+    add_tables_argument(ping_precheck)
     ping_precheck.set_defaults(function=precheck_ping)
     all_precheck = precheck_subparser.add_parser('all',
                                                  help='run all precheck tests')
@@ -468,7 +3084,8 @@ if __name__ == '__main__':
                               type=str,
                               default='',
                               help=('Set ifl interface which hosts to ping, '
-                                    'use * for patterns, '
+                                    'use * for patterns matching the start '
+                                    'of the name, '
                                     'use _ as placeholder for pattern.\n'
                                     'examples:\n'
                                     'irb.1__1* (irb.1991, irb.19911) '
@@ -477,11 +3094,15 @@ if __name__ == '__main__':
                               type=str,
                               default='',
                               help=('Set ifl interface which hosts to ping, '
-                                    'use * for patterns, '
+                                    'use * for patterns matching the start '
+                                    'of the name, '
                                     'use _ as placeholder for pattern.\n'
                                     'examples:\n'
                                     'ge-_/0/1* (1/0/1, 2/0/1)'
                                     'ge-1/1/1* (1/1/1.100, 1/1/1.101'))
+    add_ping_arguments(all_precheck)
+    add_cache_arguments(all_precheck)
+    add_tables_argument(all_precheck)
     all_precheck.set_defaults(function=precheck_all)
 
     postcheck = subparser.add_parser('postcheck',
@@ -512,6 +3133,13 @@ if __name__ == '__main__':
                                 type=int,
                                 default=0,
                                 help='ID of source PRE CHECK Table ')
+    add_login_arguments(ping_postcheck)
+    add_ping_arguments(ping_postcheck)
+    add_cache_arguments(ping_postcheck)
+    ping_postcheck.add_argument('--resume',
+                               action='store_true',
+                               help='ping only the hosts without a stored result, '
+                                    'e.g. after an interrupted run')
     ping_postcheck.set_defaults(function=postcheck_ping)
 
     all_postcheck = postcheck_subparser.add_parser('all',
@@ -531,6 +3159,8 @@ if __name__ == '__main__':
     all_postcheck.add_argument('--port',
                                default=22,
                                help='specify port to connect device 22 is default')
+    add_ping_arguments(all_postcheck)
+    add_cache_arguments(all_postcheck)
     all_postcheck.set_defaults(function=postcheck_all)
 
     report = subparser.add_parser('report',
@@ -543,7 +3173,111 @@ if __name__ == '__main__':
                         type=int,
                         default=0,
                         help='ID of destination POST check table ')
+    report.add_argument('--snapshots',
+                        nargs='+',
+                        metavar='SNAPSHOT',
+                        help=('compare any number of snapshots in the given '
+                              'order instead, e.g. precheck_5 postcheck_5 '
+                              'postcheck_6'))
+    report.add_argument('--rtt-threshold',
+                        type=float,
+                        default=Mwchecker.RTT_THRESHOLD,
+                        help=('milliseconds a host may get slower than its '
+                              'first measured rtt before it is flagged'))
     report.set_defaults(function=report_get)
+
+    monitor = subparser.add_parser('monitor',
+                                   help='Run monitoring tasks')
+    monitor_subparser = monitor.add_subparsers()
+    run_monitor = monitor_subparser.add_parser('run',
+                                               help=('re-ping hosts reachable '
+                                                     'in precheck until '
+                                                     'stopped'))
+    run_monitor.add_argument('--source',
+                             type=int,
+                             default=0,
+                             help='ID of source PRE CHECK Table ')
+    run_monitor.add_argument('--dest',
+                             type=int,
+                             default=0,
+                             help='ID of monitor table')
+    run_monitor.add_argument('--interval',
+                             type=float,
+                             default=Mwchecker.MONITOR_INTERVAL,
+                             help='seconds between the starts of two sweeps')
+    run_monitor.add_argument('--sweeps',
+                             type=int,
+                             help='stop after this many sweeps')
+    run_monitor.add_argument('--duration',
+                             type=float,
+                             help='stop after this many seconds, Ctrl-C '
+                                  'stops monitoring at any time')
+    add_login_arguments(run_monitor)
+    add_ping_arguments(run_monitor)
+    run_monitor.set_defaults(function=monitor_run,
+                             rate=Mwchecker.MONITOR_RATE)
+    report_monitor = monitor_subparser.add_parser('report',
+                                                  help=('write outages of a '
+                                                        'monitor table'))
+    report_monitor.add_argument('--dest',
+                                type=int,
+                                default=0,
+                                help='ID of monitor table')
+    report_monitor.set_defaults(function=monitor_report)
+
+    migrate_parser = subparser.add_parser('migrate',
+                                          help=('move precheck and postcheck '
+                                                'tables of older versions '
+                                                'into shared snapshot '
+                                                'storage'))
+    migrate_parser.set_defaults(function=migrate)
     arguments = parser.parse_args()
-    mwc = Mwchecker(router=arguments.router)
-    arguments.function(mwc, arguments)
+    if arguments.agent:
+        Agent(path=arguments.agent_socket or Agent.SOCKET,
+              **get_db_options(arguments)).serve()
+        sys.exit()
+    if arguments.agent_socket and (arguments.inventory or getattr(
+            arguments, 'function', None) is monitor_run):
+        parser.error('the agent runs single router tasks except monitor run')
+    if arguments.inventory and getattr(arguments, 'function', None) in (
+            monitor_run, monitor_report):
+        parser.error('monitor runs against a single router')
+    if getattr(arguments, 'tables', None) and (
+            arguments.inventory or getattr(arguments, 'irb', '') or
+            getattr(arguments, 'ifl', '')):
+        parser.error('--tables runs against a single router and replaces '
+                     '--irb and --ifl')
+    if getattr(arguments, 'interval', 1) <= 0:
+        parser.error('--interval must be positive')
+    if getattr(arguments, 'backend', None) == 'router' and not (
+            arguments.user):
+        parser.error('--backend router requires --user')
+    if arguments.agent_socket:
+        sys.exit(run_agent_job(arguments))
+    metrics = Metrics(enabled=bool(arguments.metrics_json or
+                                   arguments.metrics_prom),
+                      profile_dir=arguments.profile,
+                      labels={'router': arguments.router} if (
+                          arguments.router) else {
+                          'inventory': arguments.inventory})
+    if arguments.inventory:
+        mwc = Fleet(inventory=arguments.inventory,
+                    workers=arguments.fleet_workers,
+                    metrics=metrics,
+                    **get_ping_options(arguments),
+                    **get_db_options(arguments))
+    else:
+        mwc = Mwchecker(router=arguments.router,
+                        metrics=metrics,
+                        **get_ping_options(arguments),
+                        **get_db_options(arguments))
+    try:
+        arguments.function(mwc, arguments)
+    finally:
+        mwc.close()
+        if arguments.metrics_json:
+            metrics.export_json(arguments.metrics_json)
+        if arguments.metrics_prom:
+            metrics.export_prometheus(arguments.metrics_prom)
+    if arguments.inventory:
+        mwc.print_summary()